@@ -36,6 +36,15 @@ _loop:  ldi $0
         .endmacro
         macro2 0xAA, 0x55
 
+; .macro
+; named parameters
+        .macro macro3 dst, val
+        ldi $val
+        set $dst
+        macro2 $val, 0x55
+        .endmacro
+        macro3 r1, 0x11
+
 ; Instructions
 inst:   lda  [r1]
         sta  [r1]
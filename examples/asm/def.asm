@@ -1,5 +1,7 @@
 ; Standard definitions for ENG1448 processor
 
+      .once
+
 ; Memory-mapped I/O
       .equ btn, 0x00 ; Input register
       .equ enc, 0x01 ; Encoder counter register
@@ -1,5 +1,7 @@
 ; Example macros for ENG1448 processor
 
+.once
+
 ; Copy value from one register into another
 ; INPUT : Source value in register $1
 ; OUTPUT: Copied value in register $0
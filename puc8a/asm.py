@@ -4,55 +4,98 @@
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import sys, argparse
+import os, sys, argparse
 
 from .assembler import Preprocessor, Assembler
-from .simulator import Simulator
-from .emitter import emitvhdl
+from .optimizer import Optimizer
+from .sim import simulate
+from .emitter import emitvhdl, emitmemory, emitsidecars, FORMATS
 
 def main():
     parser = argparse.ArgumentParser(description='PUC8a Assembler (c) 2020-2025 Wouter Caarls, PUC-Rio')
-    parser.add_argument('file', type=str,
+    parser.add_argument('file', type=str, nargs='?',
                         help='ASM source file')
     parser.add_argument('-o', '--output', type=str,
                         help='Output file', default='-')
+    parser.add_argument('-f', '--format', type=str, default='vhdl', choices=['vhdl'] + list(FORMATS),
+                        help='Output format. Other formats than vhdl write the data memory to OUTPUT with _ram appended to its base name')
+    parser.add_argument('-g', action='store_true',
+                        help='Write symbol table and source map to OUTPUT with extensions .sym and .map, for use with sim-puc8a')
     parser.add_argument('-s', '--simulate', action='store_true',
                         help='Simulate resulting program')
     parser.add_argument('-t', '--test', metavar='N', type=int,
-                        help='Simulate for 1000 steps and check whether PC == N')
+                        help='Simulate until halted and check whether PC == N')
+    parser.add_argument('--max-steps', metavar='N', type=int, default=1000,
+                        help='Maximum number of steps to simulate when testing, profiling or tracing')
+    observe = parser.add_mutually_exclusive_group()
+    observe.add_argument('-p', '--profile', action='store_true',
+                        help='Simulate until halted and print execution profile')
+    observe.add_argument('--trace', metavar='FILE', type=str,
+                        help='Simulate until halted and record binary execution trace')
+    parser.add_argument('-i', '--input', type=str,
+                        help='Keyboard input for simulation, instead of prompting (escape sequences such as \\r are allowed)')
     parser.add_argument('-E', action='store_true',
                         help='Output preprocessed assembly code')
+    parser.add_argument('-O', action='store_true',
+                        help='Optimize assembly code with peephole pass')
+    parser.add_argument('--include-cache', metavar='DIR', type=str,
+                        help='Cache preprocessed include files in DIR')
+    parser.add_argument('--server', metavar='SOCKET', type=str,
+                        help='Serve compile, assemble and simulate requests on Unix socket SOCKET (- for standard input and output). The tools forward their work to the server at PUC8A_SERVER, if set')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='Number of server worker processes (default: number of CPUs)')
 
     args = parser.parse_args()
+    if args.server is not None:
+        from .server import serve
+        serve(args.server, args.workers)
+        return
+    if args.file is None:
+        parser.error('the following arguments are required: file')
+    if args.format != 'vhdl' and args.output == '-' and not args.E:
+        parser.error(f'--format {args.format} requires --output')
+    if args.g and args.output == '-':
+        parser.error('-g requires --output')
 
-    pp  = Preprocessor()
+    # Non-interactive work may be done by a running server instead
+    if os.environ.get('PUC8A_SERVER') and not args.simulate:
+        from .server import forward
+        forward('assemble')
+
+    pp  = Preprocessor(args.include_cache)
     asm = pp.process(args.file)
 
-    if args.output != '-':
+    if args.O:
+        opt = Optimizer()
+        asm = opt.process(asm)
+        print(f'Optimization saved {opt.saved} bytes', file=sys.stderr)
+
+    if args.format != 'vhdl' and not args.E:
+        f = None
+    elif args.output != '-':
         f = open(args.output, 'w')
     else:
         f = sys.stdout
 
     if args.E:
         # Don't emit machine code, just preprocessed assembly.
-        for (idx, label, inst) in asm:
-            print(idx + ' ' + (label + ': ' if label != '' else '') + inst, file=f)
+        for stmt in asm:
+            print(stmt.idx + ' ' + (stmt.label + ': ' if stmt.label != '' else '') + stmt.inst, file=f)
     else:
         ass = Assembler()
-        mem = ass.process(asm)
+        image = ass.process(asm)
 
-        if args.simulate or args.test:
-            sim = Simulator()
-            if args.simulate:
-                sim.process(mem)
-            else:
-                pc = sim.run(mem, 1000)
-                if pc != args.test:
-                    raise RuntimeError('PC after 1000 steps is ' + str(pc) + ', expected ' + str(args.test))
+        if args.simulate or args.test is not None or args.profile or args.trace:
+            simulate(image, args, args.test)
         else:
-            emitvhdl(mem, f)
+            if f is None:
+                emitmemory(image, args.output, args.format)
+            else:
+                emitvhdl(image, f)
+            if args.g:
+                emitsidecars(image, args.output)
 
-    if args.output != '-':
+    if f is not None and args.output != '-':
         f.close()
 
 if __name__ == '__main__':
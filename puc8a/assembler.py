@@ -2,8 +2,10 @@
 (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import sys, os, string, math, re
+import sys, os, string, math, re, itertools, hashlib, pickle, tempfile
+from collections import namedtuple, OrderedDict
 from .instructions import defs
+from .image import Image
 
 def _split(s, delim=r'\s'):
     """https://stackoverflow.com/questions/16710076/python-split-a-string-respect-and-preserve-quotes"""
@@ -37,13 +39,276 @@ def split(s):
             operands[i] = '[r13]'
     return mnemonic, operands
 
+class Operand(namedtuple('Operand', ['kind', 'value', 'text'])):
+    """Typed instruction operand.
+
+    kind is 'reg' (register number), 'ind' (register-indirect memory
+    request, register number), 'mem' (direct memory request, inner
+    Operand), 'num' (integer), 'char' (character code), 'label' (label
+    name), 'str' (string contents) or 'name' (anything else, such as a
+    section name). text is the normalized source text."""
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, o):
+        """Classifies operand text."""
+        if len(o) > 1 and o[0] == 'r' and o[1:].isdigit():
+            return cls('reg', int(o[1:]), o)
+        if len(o) > 2 and o[0] == '[' and o[-1] == ']':
+            inner = cls.parse(o[1:-1])
+            if inner.kind == 'reg':
+                return cls('ind', inner.value, o)
+            return cls('mem', inner, o)
+        if len(o) > 1 and o[0] == '@':
+            return cls('label', o[1:], o)
+        if len(o) == 3 and o[0] == '"' and o[-1] == '"':
+            return cls('char', ord(o[1]), o)
+        if len(o) > 1 and o[0] in '"\'' and o[-1] in '"\'':
+            return cls('str', o[1:-1], o)
+        try:
+            return cls('num', int(o, 0), o)
+        except ValueError:
+            return cls('name', o, o)
+
+class Statement(namedtuple('Statement', ['source', 'label', 'inst', 'mnemonic', 'operands', 'idx'])):
+    """Parsed assembly statement.
+
+    source is a (file, line) tuple, and idx the combined string used in
+    listings, which is filled in after preprocessing. Label-only statements
+    have an empty inst and mnemonic."""
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, source, label, inst):
+        """Splits an instruction and classifies its operands."""
+        if inst == '':
+            return cls(source, label, '', '', (), None)
+        mnemonic, operands = split(inst)
+        return cls(source, label, inst, mnemonic, tuple(Operand.parse(o) for o in operands), None)
+
+def reindex(asm):
+    """Returns Statements with file and line numbers combined into a
+    single string."""
+    midx = 0
+    ml = 0
+    for a in asm:
+        midx = max(len(a.source[0]), midx)
+        ml = max(ml, a.source[1])
+    if ml > 0:
+        ml = math.ceil(math.log10(ml))
+
+    ret = []
+    for a in asm:
+        ret.append(a._replace(idx=f'{a.source[0]:>{midx}}:{a.source[1]:>{ml}}'))
+    return ret
+
+class Macro:
+    """Precompiled assembly macro.
+
+    Body lines are kept as parsed Statements. Lines that use arguments or
+    local labels also get a template of their instruction text, alternating
+    literal strings with slots: an int selects a call argument, and None
+    inserts the local label suffix of the call."""
+    PARAM = re.compile(r'[a-z_]\w*')
+
+    def __init__(self, name, params, body):
+        self.name = name
+        self.params = params
+        self.lines = [(stmt, self._compile(stmt)) for stmt in body]
+
+    def _compile(self, stmt):
+        """Returns template of a body line, or None if it has no slots."""
+        inst = stmt.inst
+        template = []
+        start = 0
+        ii = 0
+        while ii < len(inst)-1:
+            if inst[ii] == '$':
+                # Macro argument, by position or name
+                m = self.PARAM.match(inst, ii+1)
+                if m:
+                    if m[0] not in self.params:
+                        raise SyntaxError(f'{stmt.source[0]}:{stmt.source[1]:3}: Unknown parameter ${m[0]} in macro {self.name}')
+                    arg = self.params.index(m[0])
+                    end = ii + 1 + len(m[0])
+                else:
+                    arg = ord(inst[ii+1])-ord('0')
+                    end = ii + 2
+                template += [inst[start:ii], arg]
+                start = ii = end
+            elif inst[ii] == '@' and inst[ii+1] == '_':
+                # Local label use
+                while ii < len(inst) and not inst[ii].isspace() and inst[ii] != ']':
+                    ii += 1
+                template += [inst[start:ii], None]
+                start = ii
+            else:
+                ii += 1
+
+        if start == 0:
+            return None
+        template.append(inst[start:])
+        return template
+
+    def expand(self, source, args, suffix):
+        """Returns list of Statements for a call at source with operand
+        texts args. Local labels get suffix appended."""
+        if self.params and len(args) != len(self.params):
+            raise SyntaxError(f'{source[0]}:{source[1]:3}: Macro {self.name} requires {len(self.params)} argument(s), found {len(args)}')
+
+        ret = []
+        for stmt, template in self.lines:
+            label = stmt.label
+            if label != '' and label[0] == '_':
+                # Make label definition local
+                label = label + suffix
+
+            if template is None:
+                ret.append(stmt._replace(label=label))
+                continue
+
+            parts = []
+            for t in template:
+                if t is None:
+                    parts.append(suffix)
+                elif isinstance(t, str):
+                    parts.append(t)
+                elif t >= 0 and t < len(args):
+                    parts.append(args[t])
+                else:
+                    raise SyntaxError(f'{source[0]}:{source[1]:3}: Invalid argument ${t} in call to macro {self.name}')
+            ret.append(Statement.parse(stmt.source, label, ''.join(parts)))
+        return ret
+
+class Unit:
+    """Preprocessed source file.
+
+    items holds the Statements of the file, with the key of the Unit of
+    each .include in its place. macros holds the macros defined by the file
+    and its includes, and deps the keys of all included files. Files with a
+    .once directive are only emitted the first time they are included."""
+    def __init__(self, key):
+        self.key = key
+        self.items = []
+        self.macros = {}
+        self.deps = set()
+        self.once = False
+
+# Preprocessed files, keyed by (file, resolved path, mtime, content hash).
+# Only the UNITS most recently used are kept, such that long-running
+# processes do not accumulate every version of every file.
+_units = OrderedDict()
+UNITS = 256
+
+def _remember(key, unit):
+    """Stores Unit in the in-process cache as most recently used."""
+    _units[key] = unit
+    _units.move_to_end(key)
+    while len(_units) > UNITS:
+        _units.popitem(last=False)
+
 class Preprocessor:
-    """Assembly preprocessor."""
+    """Assembly preprocessor.
+
+    Included files are preprocessed once and cached in-process, and
+    optionally on disk in directory cache."""
+    VERSION = 1
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
     def process(self, file):
         """Preprocesses the source, resolving .include and .macro directives,
-        and normalizing the instructions."""
-        asm, _ = self._preprocess(file)
-        return self._reindex(asm)
+        and normalizing the instructions. Returns a list of Statements."""
+        self.keys = {}
+        if isinstance(file, str):
+            unit = self._load(file)
+        else:
+            unit = self._preprocess(file.readlines(), '<stdin>', None)
+
+        included = {unit.key[1]} if unit.once and unit.key is not None else set()
+        asm = []
+        self._flatten(unit.items, asm, included)
+        return reindex(asm)
+
+    def _key(self, file):
+        """Returns cache key of a file."""
+        if file not in self.keys:
+            path = os.path.realpath(file)
+            with open(path, 'rb') as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+            self.keys[file] = (file, path, mtime, hashlib.sha256(data).hexdigest())
+        return self.keys[file]
+
+    def _valid(self, unit):
+        """Checks whether none of the files included by a Unit changed."""
+        try:
+            return all(self._key(dep[0]) == dep for dep in unit.deps)
+        except OSError:
+            return False
+
+    def _load(self, file):
+        """Returns the preprocessed Unit of a file."""
+        key = self._key(file)
+        unit = _units.get(key)
+        if unit is None and self.cache is not None:
+            unit = self._read(key)
+        if unit is not None and self._valid(unit):
+            _remember(key, unit)
+            return unit
+
+        with open(file, 'r') as f:
+            unit = self._preprocess(f.readlines(), file, key)
+        _remember(key, unit)
+        if self.cache is not None:
+            self._write(unit)
+        return unit
+
+    def _cachefile(self, key):
+        """Returns on-disk cache filename for a key."""
+        return os.path.join(self.cache, hashlib.sha256(repr((self.VERSION,) + key).encode()).hexdigest() + '.pickle')
+
+    def _read(self, key):
+        """Reads Unit from the on-disk cache, returning None if absent."""
+        try:
+            with open(self._cachefile(key), 'rb') as f:
+                unit = pickle.load(f)
+            return unit if unit.key == key else None
+        except Exception:
+            return None
+
+    def _write(self, unit):
+        """Writes Unit to the on-disk cache. Failures are ignored, such
+        that preprocessing itself still succeeds."""
+        try:
+            os.makedirs(self.cache, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(unit, f)
+                os.replace(tmp, self._cachefile(unit.key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            pass
+
+    def _flatten(self, items, code, included):
+        """Emits Statements of a Unit, recursively inserting included files.
+        Files with a .once directive are skipped if their resolved path is
+        in included."""
+        for item in items:
+            if isinstance(item, Statement):
+                code.append(item)
+                continue
+
+            unit = self._load(item[0])
+            if unit.once:
+                if unit.key[1] in included:
+                    continue
+                included.add(unit.key[1])
+            self._flatten(unit.items, code, included)
 
     def _normalize(self, line):
         """Strips comments and lowers uppercase characters."""
@@ -61,22 +326,16 @@ class Preprocessor:
         else:
             return ('',line)
 
-    def _preprocess(self, file, macros={}):
+    def _preprocess(self, lines, file, key):
         """Resolves .include and .macro directives, and splits .db directives into single bytes."""
-        asm = []
-        macros = macros.copy()
+        unit = Unit(key)
+        asm = unit.items
+        macros = unit.macros
         macro = ''
         nonce = 0
+        dir = os.path.dirname(file) if key is not None else '.'
 
-        if isinstance(file, str):
-            dir = os.path.dirname(file)
-            f = open(file, 'r')
-        else:
-            dir = '.'
-            f = file
-            file = '<stdin>'
-
-        for idx, line in enumerate(f.readlines()):
+        for idx, line in enumerate(lines):
             idx = idx + 1
 
             if macro == '':
@@ -84,12 +343,14 @@ class Preprocessor:
                 code = asm
             else:
                 # Currently processing a macro; emit into that.
-                code = macros[macro]
+                code = body
 
             (label, inst) = self._splitlabel(self._normalize(line))
 
             if inst != '':
-                mnemonic, operands = split(inst)
+                stmt = Statement.parse((file, idx), label, inst)
+                mnemonic = stmt.mnemonic
+                operands = [o.text for o in stmt.operands]
                 if len(operands) > 0:
                     o = operands[0]
 
@@ -100,23 +361,33 @@ class Preprocessor:
                     if len(o) < 3 or (o[0] != '"' and o[0] != '\'') or (o[-1] != '"' and o[-1] != '\''):
                         raise SyntaxError(f'{file}:{idx:3}: Malformed string constant {o}')
                     if label != '':
-                        code.append((file, idx, label, ''))
-                    asm2, macros2 = self._preprocess(os.path.join(dir, o[1:-1]))
-                    for line2 in asm2:
-                        code.append(line2)
-                    macros.update(macros2)
+                        code.append(Statement.parse((file, idx), label, ''))
+                    unit2 = self._load(os.path.join(dir, o[1:-1]))
+                    if macro == '':
+                        code.append(unit2.key)
+                    else:
+                        self._flatten([unit2.key], code, set())
+                    macros.update(unit2.macros)
+                    unit.deps.add(unit2.key)
+                    unit.deps.update(unit2.deps)
+                elif mnemonic == '.once':
+                    # Skip repeated includes of this file.
+                    if label != '':
+                        code.append(Statement.parse((file, idx), label, ''))
+                    unit.once = True
                 elif mnemonic == '.db':
                     # Split .db into single-byte constants
                     tmp = label
-                    for o in operands:
-                        if o[0] == r'"':
-                            if len(o) < 3 or o[-1] != r'"':
+                    for o in stmt.operands:
+                        if o.text[0] == r'"':
+                            if len(o.text) < 3 or o.text[-1] != r'"':
                                 raise SyntaxError(f'{file}:{idx:3}: Malformed string constant')
-                            for c in o[1:-1]:
-                                code.append((file, idx, tmp, r'.db "' + c + r'"'))
+                            for c in o.text[1:-1]:
+                                c = Operand('char', ord(c), r'"' + c + r'"')
+                                code.append(Statement((file, idx), tmp, '.db ' + c.text, '.db', (c,), None))
                                 tmp = ''
                         else:
-                            code.append((file, idx, tmp, '.db ' + o))
+                            code.append(Statement((file, idx), tmp, '.db ' + o.text, '.db', (o,), None))
                             tmp = ''
                 elif mnemonic == '.zero':
                     # Split .zero into separate .db directives
@@ -129,84 +400,75 @@ class Preprocessor:
                     except:
                         raise ValueError(f'{idx}: Cannot parse number of zeros {o}')
 
+                    zero = (Operand('num', 0, '0'),)
                     for i in range(num):
-                        code.append((file, idx, tmp, '.db 0'))
+                        code.append(Statement((file, idx), tmp, '.db 0', '.db', zero, None))
                         tmp = ''
                 elif mnemonic == '.macro':
-                    # Create a new macro.
-                    if len(operands) != 1:
+                    # Create a new macro, with optional named parameters.
+                    tokens = inst.split(None, 2)
+                    params = [p.strip() for p in tokens[2].split(',')] if len(tokens) > 2 else []
+                    if len(tokens) < 2:
                         raise SyntaxError(f'{file}:{idx:3}: Missing macro name')
                     elif macro != '':
                         raise SyntaxError(f'{file}:{idx:3}: Cannot nest macro definitions')
-                    elif o in defs:
-                        raise SyntaxError(f'{file}:{idx:3}: Macro definition {o} shadows mnemonic')
-                    elif o in macros:
-                        raise SyntaxError(f'{file}:{idx:3}: Redefinition of macro {o}')
-                    macro = o
-                    macros[macro] = []
+                    elif tokens[1] in defs:
+                        raise SyntaxError(f'{file}:{idx:3}: Macro definition {tokens[1]} shadows mnemonic')
+                    elif tokens[1] in macros:
+                        raise SyntaxError(f'{file}:{idx:3}: Redefinition of macro {tokens[1]}')
+                    for p in params:
+                        if not Macro.PARAM.fullmatch(p) or params.count(p) > 1:
+                            raise SyntaxError(f'{file}:{idx:3}: Invalid macro parameter {p}')
+                    macro = tokens[1]
+                    body = []
                 elif mnemonic == '.endmacro':
                     # Macro finished.
+                    macros[macro] = Macro(macro, params, body)
                     macro = ''
                 elif mnemonic in macros:
-                    # Macro call. Emit macro contents into main instruction stream.
+                    # Macro call. Emit macro contents into current instruction stream.
                     if label != '':
-                        code.append((file, idx, label, ''))
-
-                    for (file2, idx2, label2, inst2) in macros[mnemonic]:
-                        newinst = ''
-                        ii = 0
-                        if label2 != '' and label2[0] == '_':
-                            # Make label definition local
-                            label2 = label2 + str(nonce) + '_'
-                        while ii < len(inst2):
-                            if inst2[ii] == '$' and ii < len(inst2)-1:
-                                # Resolve macro argument
-                                arg = ord(inst2[ii+1])-ord('0');
-                                if arg >= 0 and arg < len(operands):
-                                    newinst = newinst + operands[arg]
-                                    ii += 2
-                                else:
-                                    raise SyntaxError(f'Invalid argument ${arg} in call to macro {mnemonic}')
-                            elif inst2[ii] == '@' and ii < len(inst2)-1 and inst2[ii+1] == '_':
-                                # Make label use local
-                                while ii < len(inst2) and not inst2[ii].isspace() and inst2[ii] != ']':
-                                    newinst = newinst + inst2[ii]
-                                    ii += 1
-                                newinst = newinst + str(nonce) + '_'
-                            else:
-                                newinst = newinst + inst2[ii]
-                                ii += 1
-
-                        code.append((file2, idx2, label2, newinst))
+                        code.append(Statement.parse((file, idx), label, ''))
+
+                    code.extend(macros[mnemonic].expand((file, idx), operands, str(nonce) + '_'))
                     nonce += 1
                 else:
-                    code.append((file, idx, label, inst))
+                    code.append(stmt)
             elif label != '':
-                code.append((file, idx, label, inst))
+                code.append(Statement.parse((file, idx), label, ''))
 
-        f.close()
+        if macro != '':
+            # Unterminated macro extends to end of file
+            macros[macro] = Macro(macro, params, body)
 
-        return asm, macros
+        return unit
 
-    def _reindex(self, asm):
-        """Combines file and line numbers into a single string."""
-        midx = 0
-        ml = 0
-        for a in asm:
-            midx = max(len(a[0]), midx)
-            ml = max(ml, a[1])
-        if ml > 0:
-            ml = math.ceil(math.log10(ml))
+# Operand kinds accepted by each requirement in defs
+KINDS = {'R': ('reg',), 'A': ('ind',), 'B': ('mem',),
+         '4': ('num', 'label'), '8': ('num', 'label', 'char'),
+         'X': ('reg', 'ind', 'mem', 'num', 'char', 'label', 'str', 'name')}
 
-        ret = []
-        for a in asm:
-            ret.append((f'{a[0]:>{midx}}:{a[1]:>{ml}}', a[2], a[3]))
-        return ret
+Encoding = namedtuple('Encoding', ['opcode', 'minor', 'width', 'req'])
+
+def _compile(defs):
+    """Precompiles instruction definitions into a dictionary keyed by
+    mnemonic and tuple of operand kinds. Earlier definitions take
+    precedence."""
+    shapes = {}
+    for mnemonic, encodings in defs.items():
+        for (opcode, minor, req) in encodings:
+            enc = Encoding(int(opcode, 2) if opcode != '' else None,
+                           int(minor, 2) if minor != '' else 0, len(minor), req)
+            for kinds in itertools.product(*[KINDS[r] for r in req]):
+                shapes.setdefault((mnemonic, kinds), enc)
+    return shapes
+
+shapes = _compile(defs)
 
 class Assembler:
     """Assembler for normalized assembly."""
     def process(self, asm):
-        """Emits machine code for normalized assembly."""
+        """Emits machine code for preprocessed Statements."""
         labels = self._pass1(asm)
         return self._pass2(asm, labels)
 
@@ -216,25 +478,23 @@ class Assembler:
         labels = {}
         loc = {'code': 0, 'data': 0}
 
-        for (idx, label, inst) in lines:
+        for stmt in lines:
+            idx, label, mnemonic, operands = stmt.idx, stmt.label, stmt.mnemonic, stmt.operands
             if label != '':
                 if label in labels:
                     raise SyntaxError(f'{idx}: Redefinition of label {label}')
 
                 labels[label] = loc[section]
 
-            if inst == '':
+            if mnemonic == '':
                 continue
 
-            mnemonic, operands = split(inst)
-
             if mnemonic == '.org':
                 if len(operands) < 1:
                     raise SyntaxError(f'{idx}: {mnemonic} directive requires an address argument')
-                try:
-                    newloc = int(operands[0], 0)
-                except:
-                    raise ValueError(f'{idx}: Cannot parse {mnemonic} address {operands[0]}')
+                if operands[0].kind != 'num':
+                    raise ValueError(f'{idx}: Cannot parse {mnemonic} address {operands[0].text}')
+                newloc = operands[0].value
                 if newloc < loc[section]:
                     raise ValueError(f'{idx}: {mnemonic} argument cannot reduce current address {loc}')
                 loc[section] = newloc
@@ -247,14 +507,16 @@ class Assembler:
                 if len(operands) < 2:
                     raise SyntaxError(f'{idx}: {mnemonic} directive requires 2 arguments')
 
-                if operands[0] in labels:
-                    raise SyntaxError(f'{idx}: Redefinition of equ {operands[0]}')
+                if operands[0].text in labels:
+                    raise SyntaxError(f'{idx}: Redefinition of equ {operands[0].text}')
+                if operands[1].kind != 'num':
+                    raise ValueError(f'{idx}: Cannot parse {mnemonic} value {operands[1].text}')
 
-                labels[operands[0]] = int(operands[1], 0)
+                labels[operands[0].text] = operands[1].value
             elif mnemonic == '.db' and section == 'code':
                 raise ValueError(f'{idx}: Cannot use .db in code section')
             elif mnemonic == '.section':
-                section = operands[0]
+                section = operands[0].text
             elif mnemonic == 'ldi' or mnemonic[0] == 'b':
                 loc[section] += 2
             else:
@@ -263,73 +525,84 @@ class Assembler:
         return labels
 
     def _resolve(self, lidx, mnemonic, operands, labels):
-        """Resolves instruction operands."""
+        """Resolves instruction operands, returning the Encoding and
+        operand values."""
+        enc = shapes.get((mnemonic, tuple(o.kind for o in operands)))
+        if enc is None:
+            self._mismatch(lidx, mnemonic, operands, labels)
+
+        return enc, [self._value(lidx, mnemonic, r, o, labels) for r, o in zip(enc.req, operands)]
+
+    def _mismatch(self, lidx, mnemonic, operands, labels):
+        """Reports why operands do not fit any encoding of a mnemonic."""
         if not mnemonic in defs:
             raise SyntaxError(f"{lidx}: Unrecognized mnemonic '{mnemonic}'")
 
-        for (opcode, minor, req) in defs[mnemonic]:
-            try:
-                if len(operands) != len(req):
-                    raise SyntaxError(f'{lidx}: {mnemonic} requires {len(req)} operand(s), found {operands}')
-
-                ret = []
-                for r, o in zip(req, operands):
-                    if r == 'R' or r == 'A':
-                        if r == 'A':
-                            # Register address
-                            if len(o) < 4 or o[0] != '[' or o[-1] != ']':
-                                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid indirect memory request")
-                            o = o[1:-1]
-
-                        # Register
-                        if len(o) < 2 or o[0] != 'r' or int(o[1:]) < 0 or int(o[1:]) > 15:
-                            raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid register")
-                        ret.append(f'{int(o[1:]):04b}')
-                    elif r == '4' or r == '8' or r == 'B':
-                        if r == 'B':
-                            # Constant address
-                            if len(o) < 2 or o[0] != '[' or o[-1] != ']':
-                                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid direct memory request")
-                            o = o[1:-1]
-
-                        # Constant or label evaluated as constant
-                        if len(o) > 1 and o[0] == '@':
-                            if o[1:] in labels:
-                                if r == '4':
-                                    ret.append(f'{labels[o[1:]]:04b}')
-                                else:
-                                    ret.append(f'{labels[o[1:]]:08b}')
-                            else:
-                                raise ValueError(f"{lidx}: label '{o}' not defined")
-                        elif r != '4' and len(o) == 3 and o[0] == r'"' and o[-1] == r'"':
-                            ret.append(f'{ord(o[1]):08b}')
-                        else:
-                            try:
-                                val = int(o, 0)
-                            except:
-                                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o}' is not a valid constant")
-                            if r == '4':
-                                if val < -8 or val > 15:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' is not a valid 4-bit signed or unsigned constant")
-                                if val < 0:
-                                     val = 16+val
-                                ret.append(f'{val:04b}')
-                            else:
-                                if val < -128 or val > 255:
-                                    raise ValueError(f"{lidx}: {mnemonic} operand '{o}' is not a valid 8-bit signed or unsigned constant")
-                                if val < 0:
-                                    val = 256+val
-                                ret.append(f'{val:08b}')
-                    else:
-                        ret.append(o)
-                return opcode, minor, ret
-            except Exception as e:
-                lastex = e
-        raise lastex
+        # Diagnose against last candidate encoding
+        opcode, minor, req = defs[mnemonic][-1]
+        if len(operands) != len(req):
+            raise SyntaxError(f'{lidx}: {mnemonic} requires {len(req)} operand(s), found {[o.text for o in operands]}')
+        for r, o in zip(req, operands):
+            self._value(lidx, mnemonic, r, o, labels)
+        raise SyntaxError(f'{lidx}: Invalid operands for {mnemonic}')
+
+    def _value(self, lidx, mnemonic, r, o, labels):
+        """Returns value of operand o for requirement r."""
+        if r == 'X':
+            return o.text
+
+        if r == 'R' or r == 'A':
+            if r == 'A':
+                # Register address
+                if o.kind == 'ind':
+                    o = Operand('reg', o.value, o.text[1:-1])
+                elif o.kind == 'mem':
+                    o = o.value
+                else:
+                    raise SyntaxError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid indirect memory request")
+
+            # Register
+            if o.kind != 'reg' or o.value > 15:
+                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid register")
+            return o.value
+
+        if r == 'B':
+            # Constant address
+            if o.kind != 'mem':
+                raise SyntaxError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid direct memory request")
+            o = o.value
+
+        # Constant or label evaluated as constant
+        if o.kind == 'label':
+            if o.value not in labels:
+                raise ValueError(f"{lidx}: label '{o.text}' not defined")
+            val = labels[o.value]
+        elif r != '4' and o.kind == 'char':
+            return o.value
+        elif o.kind != 'num':
+            raise SyntaxError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid constant")
+        else:
+            val = o.value
+
+        if r == '4':
+            if val < -8 or val > 15:
+                raise ValueError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid 4-bit signed or unsigned constant")
+            return val % 16
+        if val < -128 or val > 255:
+            raise ValueError(f"{lidx}: {mnemonic} operand '{o.text}' is not a valid 8-bit signed or unsigned constant")
+        return val % 256
+
+    def _encode(self, enc, operands):
+        """Concatenates opcode, 4-bit operands and minor into an instruction byte."""
+        byte = enc.opcode
+        for o in operands:
+            byte = byte << 4 | o
+        return byte << enc.width | enc.minor
 
     def _pass2(self, lines, labels):
         """Emits machine code."""
-        mem = {'code': [], 'data': []}
+        image = Image()
+        image.symbols = dict(labels)
         section = 'code'
 
         ls = 0
@@ -337,7 +610,8 @@ class Assembler:
             ls = max(ls, len(l))
 
         ref = ' ' * (ls + 2)
-        for (idx, label, inst) in lines:
+        for stmt in lines:
+            idx, label, inst = stmt.idx, stmt.label, stmt.inst
             if label != '':
                 ref = f'{label}: ' + ' ' * (ls-len(label))
             else:
@@ -346,8 +620,8 @@ class Assembler:
             if inst == '':
                 continue
 
-            mnemonic, operands = split(inst)
-            opcode, minor, operands = self._resolve(idx, mnemonic, operands, labels)
+            mnemonic, source = stmt.mnemonic, stmt.source
+            enc, operands = self._resolve(idx, mnemonic, stmt.operands, labels)
 
             if mnemonic == '.section':
                 section = operands[0]
@@ -356,35 +630,19 @@ class Assembler:
                 pass
             elif mnemonic == '.org':
                 # Fill memory until requested address
-                while len(mem[section]) < int('0b' + operands[0], 0):
-                    if section == 'code':
-                        mem[section].append(('00000000000000000', ''))
-                    else:
-                        mem[section].append(('00000000', ''))
+                image.pad(section, operands[0])
             elif mnemonic == '.db':
                 # Add byte into instruction stream
-                mem[section].append((operands[0], f'{idx}: {ref}{inst}'))
+                image.append(section, operands[0], f'{idx}: {ref}{inst}', source)
             elif section != 'code':
                 raise ValueError(f'{idx}: Cannot use instructions in data section')
             elif mnemonic == 'ldi' or mnemonic[0] == 'b':
-                instcode = opcode
-                instcode += minor
-
-                mem[section].append((instcode, f'{idx}: {ref}{inst}'))
-
-                instcode = ''
-                for o in operands:
-                    instcode += o
-
-                mem[section].append((instcode, ''))
+                # Immediate operand goes into next byte
+                image.append(section, self._encode(enc, []), f'{idx}: {ref}{inst}', source)
+                image.append(section, operands[0], '', source)
             else:
-                instcode = opcode
-                for o in operands:
-                    instcode += o
-                instcode += minor
-
-                mem[section].append((instcode, f'{idx}: {ref}{inst}'))
+                image.append(section, self._encode(enc, operands), f'{idx}: {ref}{inst}', source)
 
             ref = ' ' * (ls + 2)
 
-        return mem
+        return image
@@ -0,0 +1,212 @@
+"""Batch simulator for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import numpy as np
+
+from .simulator import State
+
+# Instruction kinds. ALU instructions are numbered by their 4-bit opcode.
+LDA, STA, LDI, BRANCH, GET, SET = 0, 1, 4, 5, 6, 7
+ADD, SUB, INC, DEC, AND, OR, XOR, SHFT = range(8, 16)
+ILLEGAL = 16
+
+class BatchState:
+    """Machine states of a batch of processors, one lane per machine."""
+    def __init__(self, n):
+        self.acc = np.zeros(n, dtype=np.int64)
+        self.regs = np.zeros((n, 16), dtype=np.int64)
+        self.mem = np.zeros((n, 256), dtype=np.int64)
+        self.regs[:, 14] = 255
+        self.zero = np.zeros(n, dtype=bool)
+        self.carry = np.zeros(n, dtype=bool)
+        self.negative = np.zeros(n, dtype=bool)
+        self.overflow = np.zeros(n, dtype=bool)
+
+        # Per-lane keyboard input, LCD output and error message
+        self.input = [[] for i in range(n)]
+        self.output = ['' for i in range(n)]
+        self.error = [None for i in range(n)]
+
+    def __len__(self):
+        return len(self.acc)
+
+    def lane(self, i):
+        """Returns the state of a single lane as a simulator State."""
+        state = State()
+        state.acc = int(self.acc[i])
+        state.regs = [int(v) for v in self.regs[i]]
+        state.mem = bytearray(int(v) for v in self.mem[i])
+        state.zero = bool(self.zero[i])
+        state.carry = bool(self.carry[i])
+        state.negative = bool(self.negative[i])
+        state.overflow = bool(self.overflow[i])
+        return state
+
+class BatchSimulator:
+    """Simulates a batch of machines in lockstep.
+
+    Each lane may run a different program. Lanes that fault (running past
+    the end of code memory, executing an illegal instruction or addressing
+    memory beyond 255) are stopped and their error message is recorded in
+    BatchState.error, while the other lanes continue.
+
+    Keyboard reads take the next character from BatchState.input, or 0 if
+    it is empty. LCD writes are appended to BatchState.output."""
+    def load(self, images):
+        """Decodes a list of memory images, one per lane, and returns the
+        decoded program together with the initial batch state."""
+        n = len(images)
+        width = max([len(image.code) for image in images] + [1]) + 1
+
+        code = np.zeros((n, width), dtype=np.int64)
+        imm = np.zeros((n, width), dtype=np.int64)
+        length = np.zeros(n, dtype=np.int64)
+        state = BatchState(n)
+
+        for i, image in enumerate(images):
+            c = np.frombuffer(bytes(image.code), dtype=np.uint8)
+            length[i] = len(c)
+            code[i, :len(c)] = c
+            imm[i, :len(c)] = np.roll(c, -1)
+            d = np.frombuffer(bytes(image.data), dtype=np.uint8)
+            if len(d) > state.mem.shape[1]:
+                raise ValueError(f'Data section has {len(d)} bytes, but data memory has only {state.mem.shape[1]}')
+            state.mem[i, :len(d)] = d
+
+        r = code & 15
+        kind = code >> 4
+        kind[(kind == 2) | (kind == 3)] = ILLEGAL
+        kind[(kind == LDI) & (r != 0)] = ILLEGAL
+        kind[(kind == BRANCH) & (r > 6)] = ILLEGAL
+
+        return (kind, r, imm, code, length), state
+
+    def run(self, images, steps=1000, inputs=None):
+        """Simulates a list of images for a set number of steps and
+        returns the final batch state."""
+        program, state = self.load(images)
+        if inputs is not None:
+            state.input = [list(inp) for inp in inputs]
+        self.resume(program, state, steps)
+        return state
+
+    def resume(self, program, state, steps):
+        """Continues simulating a batch state for a set number of steps."""
+        lanes = np.array([i for i in range(len(state)) if state.error[i] is None], dtype=np.int64)
+        for s in range(steps):
+            if len(lanes) == 0:
+                break
+            lanes = self._step(program, state, lanes)
+
+    def _fault(self, state, lanes, messages):
+        """Stops lanes, recording their error messages."""
+        for lane, message in zip(lanes, messages):
+            state.error[lane] = message
+
+    def _step(self, program, state, lanes):
+        """Executes one instruction in every lane. Returns remaining lanes."""
+        kind, r, imm, code, length = program
+        regs, mem = state.regs, state.mem
+
+        pc = regs[lanes, 15]
+
+        # Stop lanes that ran out of code memory
+        bad = pc >= length[lanes]
+        if bad.any():
+            self._fault(state, lanes[bad], ['list index out of range'] * int(bad.sum()))
+            lanes, pc = lanes[~bad], pc[~bad]
+
+        k = kind[lanes, pc]
+        rr = r[lanes, pc]
+        ii = imm[lanes, pc]
+
+        # Reading the PC yields the address of the next instruction
+        npc = pc + 1
+        val = np.where(rr == 15, npc, regs[lanes, rr])
+
+        # Stop lanes with illegal instructions or memory accesses
+        illegal = k == ILLEGAL
+        outside = ((k == LDA) | (k == STA)) & (val > 255)
+        bad = illegal | outside
+        if bad.any():
+            messages = [f'Illegal instruction {c:08b}' if i else 'bytearray index out of range'
+                        for c, i in zip(code[lanes[bad], pc[bad]], illegal[bad])]
+            self._fault(state, lanes[bad], messages)
+            ok = ~bad
+            lanes, pc, k, rr, ii, npc, val = lanes[ok], pc[ok], k[ok], rr[ok], ii[ok], npc[ok], val[ok]
+
+        acc = state.acc[lanes]
+        newacc = acc.copy()
+
+        # Memory access
+        m = k == LDA
+        if m.any():
+            newacc[m] = mem[lanes[m], val[m]]
+            kdr = m & (val == 2)
+            for i in np.nonzero(kdr)[0]:
+                inp = state.input[lanes[i]]
+                newacc[i] = ord(inp.pop(0)) & 255 if len(inp) > 0 else 0
+
+        m = k == STA
+        if m.any():
+            out = m & ((val == 7) | ((val == 8) & (acc == 1)))
+            store = m & ~out
+            mem[lanes[store], val[store]] = acc[store]
+            for i in np.nonzero(out)[0]:
+                state.output[lanes[i]] += chr(acc[i]) if val[i] == 7 else '\n'
+
+        # Immediates and branches
+        m = k == LDI
+        newacc[m] = ii[m]
+        npc[m] += 1
+
+        m = k == BRANCH
+        if m.any():
+            zero, carry = state.zero[lanes], state.carry[lanes]
+            lt = state.overflow[lanes] != state.negative[lanes]
+            taken = np.choose(rr * m, [np.ones_like(m), zero, ~zero, carry, ~carry, lt, ~lt])
+            npc[m] = np.where(taken[m], ii[m], npc[m] + 1)
+
+        # Register transfers
+        m = k == GET
+        newacc[m] = val[m]
+
+        m = k == SET
+        if m.any():
+            setpc = m & (rr == 15)
+            npc[setpc] = acc[setpc]
+            m = m & ~setpc
+            regs[lanes[m], rr[m]] = acc[m]
+
+        # ALU instructions (modify flags)
+        alu = k >= ADD
+        if alu.any():
+            l = lanes[alu]
+            ka, a, v = k[alu], acc[alu], val[alu]
+
+            shift = np.where(v > 127, a >> np.minimum(256-v, 9), a << np.minimum(v, 9))
+            res = np.select([ka == ADD, ka == SUB, ka == INC, ka == DEC, ka == AND, ka == OR, ka == XOR],
+                            [a + v, a + (256-v), v + 1, v + 255, a & v, a | v, a ^ v], shift)
+            overflow = np.select([ka == ADD, ka == SUB, ka == INC, ka == DEC],
+                                 [~(a ^ v) & (a ^ res), (a ^ v) & (a ^ res), ~(v ^ 1) & (v ^ res), (v ^ 1) & (v ^ res)], 0)
+
+            state.overflow[l] = (overflow & 128) != 0
+            state.zero[l] = (res & 255) == 0
+            state.carry[l] = (res & 256) != 0
+            state.negative[l] = (res & 128) != 0
+
+            res = res & 255
+            toreg = (ka == INC) | (ka == DEC)
+            topc = toreg & (rr[alu] == 15)
+            toreg = toreg & ~topc
+
+            idx = np.nonzero(alu)[0]
+            newacc[idx[~(toreg | topc)]] = res[~(toreg | topc)]
+            npc[idx[topc]] = res[topc]
+            regs[l[toreg], rr[alu][toreg]] = res[toreg]
+
+        state.acc[lanes] = newacc
+        regs[lanes, 15] = npc
+
+        return lanes
@@ -4,47 +4,96 @@
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import sys, io, argparse
+import os, sys, argparse
 
-from .compiler import compile
-from .assembler import Preprocessor, Assembler
-from .simulator import Simulator
-from .emitter import emitasm, emitvhdl
+from .assembler import Assembler
+from .sim import simulate
+from .emitter import emitasm, emitvhdl, emitmemory, emitsidecars, FORMATS
 
 def main():
     parser = argparse.ArgumentParser(description='PUC8a C compiler (c) 2020-2025 Wouter Caarls, PUC-Rio')
-    parser.add_argument('file', type=str,
+    parser.add_argument('file', type=str, nargs='?',
                         help='C source file')
     parser.add_argument('-o', '--output', type=str,
                         help='Output file', default='-')
+    parser.add_argument('-f', '--format', type=str, default='vhdl', choices=['vhdl'] + list(FORMATS),
+                        help='Output format. Other formats than vhdl write the data memory to OUTPUT with _ram appended to its base name')
+    parser.add_argument('-g', action='store_true',
+                        help='Write symbol table and source map to OUTPUT with extensions .sym and .map, for use with sim-puc8a')
     parser.add_argument('-s', '--simulate', action='store_true',
                         help='Simulate resulting program')
     parser.add_argument('-t', '--test', metavar='N', type=int,
-                        help='Simulate for 1000 steps and check whether PC == N')
+                        help='Simulate until halted and check whether PC == N')
+    parser.add_argument('--max-steps', metavar='N', type=int, default=1000,
+                        help='Maximum number of steps to simulate when testing, profiling or tracing')
+    observe = parser.add_mutually_exclusive_group()
+    observe.add_argument('-p', '--profile', action='store_true',
+                        help='Simulate until halted and print execution profile')
+    observe.add_argument('--trace', metavar='FILE', type=str,
+                        help='Simulate until halted and record binary execution trace')
+    parser.add_argument('-i', '--input', type=str,
+                        help='Keyboard input for simulation, instead of prompting (escape sequences such as \\r are allowed)')
     parser.add_argument('-S', action='store_true',
                         help='Output assembly code')
     parser.add_argument('-O', type=int,
                         help='Optimization level', default='2', choices=[0, 1, 2])
+    parser.add_argument('--cache-dir', metavar='DIR', type=str,
+                        default=os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'puc8a'),
+                        help='Cache compiled code in DIR (default: ~/.cache/puc8a)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always compile, without reading or writing the cache')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='Print cache statistics')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=64,
+                        help='Remove least recently used code when the cache grows beyond MB megabytes (default: 64)')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Remove all cached code (FILE is optional)')
+    parser.add_argument('--server', metavar='SOCKET', type=str,
+                        help='Serve compile, assemble and simulate requests on Unix socket SOCKET (- for standard input and output). The tools forward their work to the server at PUC8A_SERVER, if set')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='Number of server worker processes (default: number of CPUs)')
 
     args = parser.parse_args()
+    if args.server is not None:
+        from .server import serve
+        serve(args.server, args.workers)
+        return
+    if args.clear_cache:
+        from .compiler import Cache
+        Cache(args.cache_dir).prune()
+        if args.file is None:
+            return
+    if args.file is None:
+        parser.error('the following arguments are required: file')
+    if args.format != 'vhdl' and args.output == '-' and not args.S:
+        parser.error(f'--format {args.format} requires --output')
+    if args.g and args.output == '-':
+        parser.error('-g requires --output')
 
-    with open(args.file, 'r') as f:
-        asm = io.StringIO(compile(f, args.O))
+    # Non-interactive work may be done by a running server instead
+    if os.environ.get('PUC8A_SERVER') and not args.simulate:
+        from .server import forward
+        forward('compile')
+
+    # The C front end and code generator take most of the startup time,
+    # so only load them once there is something to compile.
+    from .compiler import compile, Cache
 
-    pp  = Preprocessor()
-    asm = pp.process(asm)
+    cache = Cache(args.cache_dir, args.cache_size*1024*1024) if not args.no_cache else None
+    with open(args.file, 'r') as f:
+        asm = compile(f, args.O, cache)
+    if args.cache_stats and cache is not None:
+        print(cache.stats(), file=sys.stderr)
 
     ass = Assembler()
-    mem = ass.process(asm)
+    image = ass.process(asm)
 
-    if args.simulate or args.test:
-        sim = Simulator()
-        if args.simulate:
-            sim.process(mem)
-        else:
-            pc = sim.run(mem, 1000)
-            if pc != args.test:
-                raise RuntimeError('PC after 1000 steps is ' + str(pc) + ', expected ' + str(args.test))
+    if args.simulate or args.test is not None or args.profile or args.trace:
+        simulate(image, args, args.test)
+    elif args.format != 'vhdl' and not args.S:
+        emitmemory(image, args.output, args.format)
+        if args.g:
+            emitsidecars(image, args.output)
     else:
         if args.output != '-':
             f = open(args.output, 'w')
@@ -53,10 +102,12 @@ def main():
 
         if args.S:
             # Don't emit machine code, just compiled assembly.
-            for (idx, label, inst) in asm:
-                print((label + ': ' if label != '' else '') + inst, file=f)
+            for stmt in asm:
+                print((stmt.label + ': ' if stmt.label != '' else '') + stmt.inst, file=f)
         else:
-            emitvhdl(mem, f)
+            emitvhdl(image, f)
+            if args.g:
+                emitsidecars(image, args.output)
 
         if args.output != '-':
             f.close()
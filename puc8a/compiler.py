@@ -2,19 +2,15 @@
    (c) 2020-2023 Wouter Caarls, PUC-Rio
 """
 
+import os, hashlib, pickle, logging, tempfile
 from io import StringIO
 
-from .ppci.lang.c import c_to_ir
-from .ppci.api import ir_to_assembly, optimize
-
-def compile(src, opt_level):
-    asm = """
-
-.macro mov
-get $1
-set $0
-.endmacro
+from .ppci.lang.c import CPreProcessor, COptions
+from .ppci.lang.c.token import CToken
+from .assembler import Preprocessor, reindex
 
+# Memory-mapped I/O registers and startup code
+PRELUDE = Preprocessor().process(StringIO("""
 .section data
 btn: .db 0
 enc: .db 0
@@ -35,29 +31,167 @@ dec sp
 ldi @main
 set pc
 loop: b @loop
-"""
-    ir_module = c_to_ir(src, 'puc8a')
-    optimize(ir_module, level=opt_level)
+"""))
+
+class Warnings(logging.Handler):
+    """Collects (logger, level, message) tuples of warnings logged during
+    compilation. Records are passed on to the last-resort handler if no
+    other handlers are configured, as they would be without this one."""
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+        self.echo = not logging.getLogger().handlers
+
+    def emit(self, record):
+        self.messages.append((record.name, record.levelno, record.getMessage()))
+        if self.echo and logging.lastResort is not None:
+            logging.lastResort.handle(record)
+
+_version = None
+
+def version():
+    """Returns hash of the puc8a sources, including ppci, such that cached
+    code is not used after the compiler changes."""
+    global _version
+    if _version is None:
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(os.path.dirname(__file__)):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        h.update(name.encode() + f.read())
+        _version = h.hexdigest()
+    return _version
+
+class Cache:
+    """On-disk cache of compiled C.
+
+    Entries are keyed by the preprocessed C tokens, the optimization level
+    and the version() of the compiler sources. Warnings logged while
+    compiling are stored along with the Statements and logged again when
+    the entry is used. If size is given, the least recently used entries
+    are removed when the cache grows beyond size bytes. hits and misses
+    count the lookups made through this object."""
+    def __init__(self, dir, size=None):
+        self.dir = dir
+        self.size = size
+        self.hits = 0
+        self.misses = 0
 
-    ppci_asm = StringIO(ir_to_assembly([ir_module], 'puc8a'))
+    def key(self, tokens, opt_level):
+        """Returns cache key of preprocessed tokens."""
+        h = hashlib.sha256(repr((version(), opt_level)).encode())
+        for token in tokens:
+            # Skip line markers, such that only the code matters
+            if isinstance(token, CToken):
+                h.update(repr((token.typ, token.val)).encode())
+        return h.hexdigest()
 
-    lbl = ''
-    for l in ppci_asm.readlines():
-        l = l.lstrip().rstrip()
-        if l.startswith('global') or l.startswith('type') or l.startswith('ALIGN'):
+    def read(self, key):
+        """Returns cached Statements, or None if absent."""
+        filename = os.path.join(self.dir, key + '.pickle')
+        try:
+            with open(filename, 'rb') as f:
+                k, asm, messages = pickle.load(f)
+            if k == key:
+                self.hits += 1
+                # Mark as recently used
+                os.utime(filename)
+                for name, level, message in messages:
+                    logging.getLogger(name).log(level, '%s', message)
+                return asm
+        except Exception:
             pass
-        elif l.endswith(':'):
-            if lbl != '':
-                lbl += '\n'
-            lbl += l + ' '
-        elif l.startswith('.byte'):
-            asm += lbl + ' .db' + l[5:] + '\n'
-            lbl = ''
-        elif l.startswith('section'):
-            asm += lbl + ' .' + l + '\n'
-            lbl = ''
-        else:
-            asm += lbl + l + '\n'
-            lbl = ''
+        self.misses += 1
+        return None
+
+    def write(self, key, asm, messages):
+        """Writes Statements and warnings to the cache, and removes old
+        entries if it is too large. Failures are ignored, such that the
+        compilation itself still succeeds."""
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((key, asm, messages), f)
+                os.replace(tmp, os.path.join(self.dir, key + '.pickle'))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            return
+        if self.size is not None:
+            self.prune(self.size)
+
+    def entries(self):
+        """Returns list of (path, size, mtime) of the cache entries."""
+        entries = []
+        try:
+            for e in os.scandir(self.dir):
+                if e.name.endswith('.pickle'):
+                    try:
+                        st = e.stat()
+                        entries.append((e.path, st.st_size, st.st_mtime))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return entries
+
+    def prune(self, size=0):
+        """Removes least recently used entries until the cache holds at
+        most size bytes. prune() empties the cache."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for path, n, mtime in entries:
+            if total <= size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= n
+
+    def stats(self):
+        """Returns description of cache usage and size."""
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        return f'Compile cache {self.dir}: {self.hits} hits, {self.misses} misses, {len(entries)} entries ({size} bytes)'
+
+def compile(src, opt_level, cache=None):
+    """Returns list of Statements for C source, ready to be assembled.
+    Statements are numbered consecutively, such that the source map
+    refers to the lines of the assembly listing. If cache is given,
+    unchanged sources skip parsing, optimization and code generation."""
+    coptions = COptions()
+    tokens = list(CPreProcessor(coptions).process_file(src, getattr(src, 'name', None)))
+    if cache is not None:
+        key = cache.key(tokens, opt_level)
+        asm = cache.read(key)
+        if asm is not None:
+            return asm
+
+    # Only needed on a cache miss
+    from .ppci.lang.c import c_to_ir
+    from .ppci.api import ir_to_stream, optimize
+    from .ppci.binutils.outstream import ImageOutputStream
+
+    warnings = Warnings()
+    logging.getLogger().addHandler(warnings)
+    try:
+        ir_module = c_to_ir(tokens, 'puc8a', coptions)
+        optimize(ir_module, level=opt_level)
+
+        prelude = [stmt._replace(source=('<stdin>', i+1)) for i, stmt in enumerate(PRELUDE)]
+        stream = ImageOutputStream(prelude)
+        ir_to_stream(ir_module, 'puc8a', stream)
+        stream.flush()
+    finally:
+        logging.getLogger().removeHandler(warnings)
 
+    asm = reindex(stream.statements)
+    if cache is not None:
+        cache.write(key, asm, warnings.messages)
     return asm
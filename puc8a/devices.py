@@ -0,0 +1,135 @@
+"""Memory-mapped I/O devices for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import sys
+
+# Register map, see examples/c/puc8a.h
+BTN = 0x00 # Input register
+ENC = 0x01 # Encoder counter register
+KDR = 0x02 # Keyboard data register
+UDR = 0x03 # UART data register
+USR = 0x04 # UART status register
+LED = 0x05 # LED register
+SSD = 0x06 # 7-segment display register
+LDR = 0x07 # LCD data register
+LCR = 0x08 # LCD command register
+
+class Device:
+    """Memory-mapped device register that behaves like plain memory.
+
+    Subclasses override read and write. Accesses that have an effect
+    outside the machine state (consuming input, producing output) must
+    call self.event(), so that the simulator does not mistake a program
+    that waits for I/O for one that has halted."""
+    def __init__(self):
+        self.bus = None
+        self.reads = 0
+        self.writes = 0
+
+    def event(self):
+        """Records an externally visible access."""
+        self.bus.events += 1
+
+    def read(self, mem, addr):
+        """Returns value of register at addr."""
+        self.reads += 1
+        return mem[addr]
+
+    def write(self, mem, addr, val):
+        """Writes val to register at addr."""
+        self.writes += 1
+        mem[addr] = val
+
+class Keyboard(Device):
+    """Keyboard data register.
+
+    If a script is given, each read returns its next character, or 0 (no
+    key pressed) when it is exhausted. Otherwise the user is asked for a
+    character on every read."""
+    def __init__(self, script=None):
+        super().__init__()
+        self.script = None if script is None else list(reversed(script))
+
+    def read(self, mem, addr):
+        self.reads += 1
+        self.event()
+        if self.script is not None:
+            if len(self.script) > 0:
+                return ord(self.script.pop()) & 255
+            return 0
+
+        inp = input('Enter keyboard character: ')
+        if len(inp) > 0:
+            return ord(inp[0]) & 255
+        else:
+            return 0
+
+class LCD(Device):
+    """Character LCD with data and command registers.
+
+    Characters written to the data register are printed, and the clear
+    command (1) starts a new line. Other commands are stored as in plain
+    memory. If capture is set, output is collected in self.output instead
+    of being printed."""
+    def __init__(self, data=LDR, command=LCR, capture=False):
+        super().__init__()
+        self.data = data
+        self.command = command
+        self.output = [] if capture else None
+
+    @property
+    def text(self):
+        """Returns captured output."""
+        return ''.join(self.output)
+
+    def write(self, mem, addr, val):
+        self.writes += 1
+        if addr == self.data:
+            self._emit(chr(val))
+        elif addr == self.command and val == 1:
+            self._emit('\n')
+        else:
+            mem[addr] = val
+
+    def _emit(self, s):
+        self.event()
+        if self.output is not None:
+            self.output.append(s)
+        else:
+            print(s, end='')
+
+class Bus:
+    """Maps device registers into the data address space."""
+    def __init__(self):
+        self.devices = {}
+        self.events = 0
+
+    def map(self, addr, device):
+        """Maps a device register at addr."""
+        device.bus = self
+        self.devices[addr] = device
+
+    @classmethod
+    def standard(cls, input=None, capture=False):
+        """Returns bus with the standard ENG1448 register map. Keyboard
+        input is scripted if input is given, and LCD output is captured if
+        capture is set."""
+        bus = cls()
+        for addr in [BTN, ENC, UDR, USR, LED, SSD]:
+            bus.map(addr, Device())
+        bus.map(KDR, Keyboard(input))
+        lcd = LCD(capture=capture)
+        bus.map(LDR, lcd)
+        bus.map(LCR, lcd)
+        return bus
+
+    @property
+    def keyboard(self):
+        """Returns device mapped at the keyboard data register."""
+        return self.devices[KDR]
+
+    @property
+    def lcd(self):
+        """Returns device mapped at the LCD data register."""
+        return self.devices[LDR]
@@ -16,24 +16,25 @@ class Disassembler():
         """Disassemble a single instruction, replacing addresses with labels if a memory map is available."""
         for mnemonic in defs:
             for (opcode, minor, operands) in defs[mnemonic]:
-                if opcode != '' and inst[:len(opcode)] == opcode and (minor == '' or inst[-len(minor):] == minor):
+                if opcode != '' and inst >> (8-len(opcode)) == int(opcode, 2) and \
+                   (minor == '' or inst & ((1 << len(minor))-1) == int(minor, 2)):
                     dis = f'{mnemonic:4} '
                     for i, o in enumerate(operands):
                         istart = len(opcode)+4*i
-                        reg = int(inst[istart:istart+4], 2)
+                        reg = (inst >> (4-istart)) & 15
 
                         if o == 'R':
                             dis += f'{regs[reg]}, '
                         elif o == 'A':
                             dis += f'[{regs[reg]}], '
                         elif o == 'B':
-                            addr = int(inst[istart:istart+8], 2)
+                            addr = inst & ((1 << (8-istart))-1)
                             if self.map is not None and addr in self.map['data']:
                                 dis += f"[@{self.map['data'][addr]}], "
                             else:
                                 dis += f'[{addr}], '
                         elif o == '4':
-                            val = int(inst[istart:istart+4], 2)
+                            val = reg
                             if mnemonic == 'ldr' or mnemonic == 'str':
                                 if val > 7:
                                     # signed
@@ -44,11 +45,11 @@ class Disassembler():
                                 dis += f'{val}, '
                         elif o == '8':
                             # 8-bit immediates are in next byte
-                            val = int(inst2, 2)
+                            val = inst2
                             if self.map is not None and 4*val in self.map['code'] and mnemonic[0] == 'b':
                                 dis += f"@{self.map['code'][4*val]}, "
                             else:
                                 dis += f'{val}, '
                     dis = dis[:-2]
                     return mnemonic, dis
-        raise ValueError(f'Illegal instruction {inst}')
+        raise ValueError(f'Illegal instruction {inst:08b}')
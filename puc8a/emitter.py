@@ -1,40 +1,45 @@
-"""ASM and VHDL emitter for ENG1448 8-bit processor
+"""ASM, VHDL and memory initialization emitters for ENG1448 8-bit processor
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import os
+import os, io
 
-def emitasmsection(section, f):
+from .ppci.format.hexfile import HexFile
+
+# Number of words in code and data memories
+DEPTH = 256
+
+def emitasmsection(comments, f):
     """Emit assembly for a section."""
     addr = 0
     skipped = False
-    for c in section:
-        if c[1] == '':
+    for c in comments:
+        if c == '':
             skipped = True
         else:
             if skipped == True:
                 print(f'.org {addr}', file=f)
                 skipped = False
-            print(c[1], file=f)
+            print(c, file=f)
         addr += 1
 
 
-def emitasm(mem, f):
+def emitasm(image, f):
     """Emit assembly for code and data sections."""
     print('.section code', file=f)
-    emitasmsection(mem['code'], f)
+    emitasmsection(image.comments['code'], f)
     print('.section data', file=f)
-    emitasmsection(mem['data'], f)
+    emitasmsection(image.comments['data'], f)
 
-def emitarray(section, f):
+def emitarray(section, comments, f):
     """Emit a VHDL array for a section."""
     print('(', file=f)
-    for l, c in enumerate(section):
-        if (c[0] != '00000000000000000' and c[0] != '00000000') or c[1] != '':
-            print(f"    {l:3} => \"{c[0]}\", -- {c[1]}", file=f)
+    for l, (b, c) in enumerate(zip(section, comments)):
+        if b != 0 or c != '':
+            print(f"    {l:3} => \"{b:08b}\", -- {c}", file=f)
     print("     others => (others => '0'));", file=f)
 
-def emitvhdl(mem, f):
+def emitvhdl(image, f):
     """Emit VHDL for code and data sections."""
     if f.name != '<stdout>':
         pkg = os.path.splitext(os.path.basename(f.name))[0]
@@ -50,13 +55,78 @@ package {pkg} is
     else:
         pkg = ''
         print(f"""  signal rom: ROMT := """, file=f, end='')
-    emitarray(mem['code'], f)
+    emitarray(image.code, image.comments['code'], f)
 
     if pkg != '':
         print(f'  constant {pkg}_ram: {pkg}RAMT := ', file=f, end='')
     else:
         print(f'  signal ram: RAMT := ', file=f, end='')
-    emitarray(mem['data'], f)
+    emitarray(image.data, image.comments['data'], f)
 
     if pkg != '':
         print(f'end package {pkg};', file=f)
+
+def emitsymbols(image, f):
+    """Emit symbol table, one name and value per line."""
+    for name, value in sorted(image.symbols.items(), key=lambda s: (s[1], s[0])):
+        print(f'{value:3} {name}', file=f)
+
+def emitsourcemap(image, f):
+    """Emit source map of the code section, one address and listing
+    comment per line."""
+    for addr, c in enumerate(image.comments['code']):
+        if c != '':
+            print(f'{addr:3} {c}', file=f)
+
+def formatbin(section):
+    """Returns raw binary contents of a section."""
+    return bytes(section)
+
+def formathex(section):
+    """Returns Intel HEX contents of a section."""
+    hexfile = HexFile()
+    hexfile.add_region(0, bytes(section))
+    f = io.StringIO()
+    hexfile.save(f)
+    return f.getvalue().encode()
+
+def _words(section):
+    """Returns section padded to memory depth."""
+    return bytes(section) + bytes(max(DEPTH - len(section), 0))
+
+def formatcoe(section):
+    """Returns Xilinx COE contents of a section."""
+    words = ',\n'.join(f'{b:02X}' for b in _words(section))
+    return f'memory_initialization_radix=16;\nmemory_initialization_vector=\n{words};\n'.encode()
+
+def formatmif(section):
+    """Returns Intel MIF contents of a section."""
+    words = _words(section)
+    lines = [f'DEPTH = {len(words)};', 'WIDTH = 8;', 'ADDRESS_RADIX = HEX;', 'DATA_RADIX = HEX;', 'CONTENT', 'BEGIN']
+    lines += [f'{a:02X} : {b:02X};' for a, b in enumerate(words)]
+    lines.append('END;\n')
+    return '\n'.join(lines).encode()
+
+def formatmem(section):
+    """Returns Verilog $readmemh contents of a section."""
+    return ''.join(f'{b:02X}\n' for b in _words(section)).encode()
+
+FORMATS = {'bin': formatbin, 'hex': formathex, 'coe': formatcoe, 'mif': formatmif, 'mem': formatmem}
+
+def emitmemory(image, filename, format):
+    """Write code section to filename and data section to filename with
+    _ram appended to its base name, in the given format."""
+    base, ext = os.path.splitext(filename)
+    for section, name in [('code', filename), ('data', f'{base}_ram{ext}')]:
+        contents = FORMATS[format](image.sections[section])
+        with open(name, 'wb') as f:
+            f.write(contents)
+
+def emitsidecars(image, filename):
+    """Write symbol table and source map to filename with extensions .sym
+    and .map, respectively."""
+    base = os.path.splitext(filename)[0]
+    with open(base + '.sym', 'w') as f:
+        emitsymbols(image, f)
+    with open(base + '.map', 'w') as f:
+        emitsourcemap(image, f)
@@ -0,0 +1,43 @@
+"""Memory image for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+class Image:
+    """Code and data memory contents of a program.
+
+    Each section is a bytearray. Parallel tables hold a listing comment
+    per byte ('' for bytes that do not start a statement, such as
+    immediates and padding) and a source map of (file, line) tuples, or
+    None where there is no source. symbols maps label names to their
+    values."""
+    SECTIONS = ('code', 'data')
+
+    def __init__(self, code=b'', data=b''):
+        self.sections = {'code': bytearray(code), 'data': bytearray(data)}
+        self.comments = {s: ['' for b in self.sections[s]] for s in self.SECTIONS}
+        self.sources = {s: [None for b in self.sections[s]] for s in self.SECTIONS}
+        self.symbols = {}
+
+    @property
+    def code(self):
+        """Code memory."""
+        return self.sections['code']
+
+    @property
+    def data(self):
+        """Data memory."""
+        return self.sections['data']
+
+    def append(self, section, byte, comment='', source=None):
+        """Appends a byte to a section."""
+        self.sections[section].append(byte)
+        self.comments[section].append(comment)
+        self.sources[section].append(source)
+
+    def pad(self, section, addr):
+        """Fills a section with zeros until addr."""
+        n = addr - len(self.sections[section])
+        if n > 0:
+            self.sections[section] += bytes(n)
+            self.comments[section] += [''] * n
+            self.sources[section] += [None] * n
@@ -0,0 +1,163 @@
+"""Image loaders for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import os, re
+
+from .image import Image
+from .emitter import DEPTH
+from .ppci.format.hexfile import HexFile
+
+RADIX = {'2': 2, '10': 10, '16': 16, 'bin': 2, 'dec': 10, 'uns': 10, 'hex': 16}
+
+def source(comment):
+    """Returns (file, line) prefix of a listing comment, or None."""
+    m = re.match(r'\s*(.*?):\s*(\d+):', comment)
+    if m is None:
+        return None
+    return m[1], int(m[2])
+
+def parsebin(data):
+    """Returns section contents of raw binary data."""
+    return bytearray(data)
+
+def parsehex(data):
+    """Returns section contents of Intel HEX data."""
+    hexfile = HexFile.load(data.decode().splitlines())
+    section = bytearray()
+    for region in hexfile.regions:
+        if len(section) < region.address:
+            section += bytes(region.address - len(section))
+        section[region.address:region.address+len(region.data)] = region.data
+    return section
+
+def parsecoe(data):
+    """Returns section contents of Xilinx COE data."""
+    text = re.sub(r';[^\n=]*$', '', data.decode().lower(), flags=re.M)
+    radix = re.search(r'memory_initialization_radix\s*=\s*(\d+)', text)
+    vector = re.search(r'memory_initialization_vector\s*=([^;]*)', text)
+    if vector is None:
+        raise ValueError('COE file has no memory_initialization_vector')
+    radix = RADIX[radix[1]] if radix else 16
+    return bytearray(int(v, radix) for v in re.split(r'[\s,]+', vector[1].strip()) if v != '')
+
+def parsemif(data):
+    """Returns section contents of Intel MIF data."""
+    text = re.sub(r'--.*$', '', data.decode().lower(), flags=re.M)
+    aradix = re.search(r'address_radix\s*=\s*(\w+)', text)
+    dradix = re.search(r'data_radix\s*=\s*(\w+)', text)
+    aradix = RADIX[aradix[1]] if aradix else 16
+    dradix = RADIX[dradix[1]] if dradix else 16
+    content = re.search(r'content\s+begin(.*?)end\s*;', text, flags=re.S)
+    if content is None:
+        raise ValueError('MIF file has no CONTENT section')
+
+    section = bytearray()
+    for entry in content[1].split(';'):
+        if entry.strip() == '':
+            continue
+        addr, value = entry.split(':')
+        addr = addr.strip()
+        if addr[0] == '[':
+            start, end = [int(a, aradix) for a in addr[1:-1].split('..')]
+        else:
+            start = end = int(addr, aradix)
+        values = [int(v, dradix) for v in value.split()]
+        if len(section) <= end:
+            section += bytes(end + 1 - len(section))
+        for a in range(start, end+1):
+            section[a] = values[(a-start) % len(values)]
+    return section
+
+def parsemem(data):
+    """Returns section contents of Verilog $readmemh data."""
+    text = re.sub(r'//.*$', '', data.decode(), flags=re.M)
+    section = bytearray()
+    addr = 0
+    for token in text.split():
+        if token[0] == '@':
+            addr = int(token[1:], 16)
+            continue
+        if len(section) <= addr:
+            section += bytes(addr + 1 - len(section))
+        section[addr] = int(token, 16)
+        addr += 1
+    return section
+
+PARSERS = {'bin': parsebin, 'hex': parsehex, 'coe': parsecoe, 'mif': parsemif, 'mem': parsemem}
+
+def loadvhdl(f):
+    """Returns Image of VHDL emitted by emitvhdl, including the listing
+    comments and source map."""
+    image = Image()
+    sections = iter(Image.SECTIONS)
+    section = None
+    for line in f:
+        if section is None and re.search(r'(rom|ram)\s*:.*:=\s*\(\s*$', line):
+            section = next(sections, None)
+            continue
+        m = re.match(r'\s*(\d+)\s*=>\s*"([01]{8})",\s*--\s?(.*)$', line)
+        if section is not None and m:
+            addr, comment = int(m[1]), m[3].rstrip('\n')
+            image.pad(section, addr)
+            image.append(section, int(m[2], 2), comment, source(comment) if comment != '' else None)
+        elif section is not None and 'others' in line:
+            section = None
+    return image
+
+def loadsymbols(image, f):
+    """Reads symbol table emitted by emitsymbols into image."""
+    for line in f:
+        if line.strip() != '':
+            value, name = line.split()
+            image.symbols[name] = int(value)
+
+def loadsourcemap(image, f):
+    """Reads source map emitted by emitsourcemap into image."""
+    comments, sources = image.comments['code'], image.sources['code']
+    for line in f:
+        if line.strip() == '':
+            continue
+        addr, comment = line.rstrip('\n').lstrip().split(' ', 1)
+        addr = int(addr)
+        if addr < len(comments):
+            comments[addr] = comment
+            sources[addr] = source(comment)
+
+def deduce(filename):
+    """Returns image format named by the extension of filename, which may
+    not be a known format."""
+    ext = os.path.splitext(filename)[1]
+    return 'vhdl' if ext in ('.vhd', '.vhdl') else ext[1:]
+
+def load(filename, format=None, data=None):
+    """Returns Image of a file in VHDL or one of the memory
+    initialization formats, deduced from the extension if format is None.
+    For the latter, the data section is read from data, if given, or from
+    filename with _ram appended to its base name, if it exists. Sections
+    are padded with zeros to the memory depth, like the memories that
+    the image initializes."""
+    base, ext = os.path.splitext(filename)
+    if format is None:
+        format = deduce(filename)
+
+    if format == 'vhdl':
+        with open(filename, 'r') as f:
+            image = loadvhdl(f)
+    elif format in PARSERS:
+        if data is None and os.path.exists(f'{base}_ram{ext}'):
+            data = f'{base}_ram{ext}'
+
+        with open(filename, 'rb') as f:
+            image = Image(PARSERS[format](f.read()))
+        if data is not None:
+            with open(data, 'rb') as f:
+                image.sections['data'] = PARSERS[format](f.read())
+            image.comments['data'] = ['' for b in image.data]
+            image.sources['data'] = [None for b in image.data]
+    else:
+        raise ValueError(f'Unknown image format {format}')
+
+    for section in Image.SECTIONS:
+        image.pad(section, DEPTH)
+    return image
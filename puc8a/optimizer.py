@@ -0,0 +1,364 @@
+"""Assembly optimizer for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import itertools
+
+from .assembler import Assembler, Operand, shapes
+from .devices import LCR
+
+ALU = ('add', 'sub', 'and', 'or', 'xor', 'shft')
+
+INVERSE = {'bz': 'bnz', 'beq': 'bne', 'bnz': 'bz', 'bne': 'beq',
+           'bcs': 'bcc', 'bhs': 'blo', 'bcc': 'bcs', 'blo': 'bhs',
+           'blt': 'bge', 'bge': 'blt'}
+
+class Optimizer:
+    """Optimizer for preprocessed assembly.
+
+    A control-flow pass first builds the control-flow graph of the code
+    section. It retargets branches to unconditional branches, inverts
+    conditional branches over an unconditional one, drops branches to the
+    next instruction and removes unreachable instructions. Code following
+    a .org directive, addresses used other than as branch targets and
+    return addresses computed from pc are considered reachable.
+
+    The peephole pass then works on basic blocks of the code section, delimited by labels,
+    directives, branches and writes to pc. A forward pass numbers the
+    values held by the accumulator, registers and memory, and removes
+    instructions that would not change them. A backward pass tracks
+    liveness of the accumulator and flags, and removes instructions whose
+    results are overwritten before being read. All ALU operations write
+    every flag, so they are only removed if no branch reads the flags
+    they set. Both are conservative at block boundaries.
+
+    Code must refer to instruction addresses through labels. Instructions
+    following a read of pc in the same block, as in return address
+    calculations, are never removed.
+
+    saved holds the number of bytes removed by the last call to process."""
+    def __init__(self):
+        self.saved = 0
+
+    def process(self, asm):
+        """Returns optimized list of Statements."""
+        size = sum(self._size(stmt) for stmt in asm if stmt.mnemonic != '' and stmt.mnemonic[0] != '.')
+        asm = self._peephole(self._flow(asm))
+        self.saved = size - sum(self._size(stmt) for stmt in asm if stmt.mnemonic != '' and stmt.mnemonic[0] != '.')
+        return asm
+
+    def _size(self, stmt):
+        """Returns size of an instruction in bytes."""
+        return 2 if stmt.mnemonic == 'ldi' or stmt.mnemonic[0] == 'b' else 1
+
+    def _layout(self, asm):
+        """Returns code section layout as a tuple of
+
+        - list of asm indices of instructions in code memory order,
+        - dictionary of code labels to their position in that list,
+        - set of positions that follow a .org directive,
+        - set of positions that may not change size, from a read of pc
+          up to and including the next control transfer,
+        - set of positions that return addresses computed from pc may
+          point to.
+
+        Returns None if a branch target is not a label or an instruction
+        is malformed."""
+        code = []
+        at = {}
+        barriers = set()
+        protected = set()
+        returns = set()
+        section = 'code'
+        window = False
+
+        for i, stmt in enumerate(asm):
+            mnemonic = stmt.mnemonic
+            if mnemonic == '.section':
+                section = stmt.operands[0].text
+            if section != 'code':
+                continue
+            if stmt.label != '':
+                at[stmt.label] = len(code)
+            if mnemonic == '.org':
+                barriers.add(len(code))
+            if mnemonic == '' or mnemonic[0] == '.':
+                continue
+            if (mnemonic, tuple(o.kind for o in stmt.operands)) not in shapes:
+                # Leave malformed instructions to the assembler
+                return None
+
+            o = stmt.operands[0]
+            if mnemonic[0] == 'b':
+                if o.kind != 'label':
+                    return None
+            elif o.value == 15 and mnemonic != 'set':
+                window = True
+            if window:
+                protected.add(len(code))
+                if mnemonic[0] == 'b' or (mnemonic == 'set' and o.value == 15):
+                    window = False
+                    returns.add(len(code)+1)
+            code.append(i)
+
+        return code, at, barriers, protected, returns
+
+    def _flow(self, asm):
+        """Returns list of Statements with cleaned up control flow."""
+        asm = list(asm)
+        while True:
+            layout = self._layout(asm)
+            if layout is None:
+                return asm
+            code, at, barriers, protected, returns = layout
+            stmts = [asm[i] for i in code]
+            removed = set()
+            changed = False
+
+            def target(p):
+                return at.get(stmts[p].operands[0].value)
+
+            def retarget(p, label):
+                stmt = stmts[p]
+                asm[code[p]] = stmt._replace(inst=f'{stmt.mnemonic} @{label}', operands=(Operand.parse('@' + label),))
+                stmts[p] = asm[code[p]]
+
+            # Branch chains
+            for p, stmt in enumerate(stmts):
+                if stmt.mnemonic[0] != 'b':
+                    continue
+                label, seen = stmt.operands[0].value, {p}
+                q = at.get(label)
+                while q is not None and q < len(stmts) and q not in seen and stmts[q].mnemonic == 'b':
+                    seen.add(q)
+                    label = stmts[q].operands[0].value
+                    q = at.get(label)
+                if label != stmt.operands[0].value:
+                    retarget(p, label)
+                    changed = True
+
+            # Conditional branch over unconditional branch
+            labelled = set(at.values())
+            for p, stmt in enumerate(stmts[:-1]):
+                if stmt.mnemonic in INVERSE and stmts[p+1].mnemonic == 'b' and target(p) == p+2 and \
+                   p+1 not in labelled and p+1 not in barriers and p+2 not in barriers and \
+                   not {p, p+1} & protected and not {p, p+1} & removed:
+                    asm[code[p]] = stmt._replace(mnemonic=INVERSE[stmt.mnemonic])
+                    stmts[p] = asm[code[p]]
+                    retarget(p, stmts[p+1].operands[0].value)
+                    removed.add(p+1)
+
+            # Branch to next instruction
+            for p, stmt in enumerate(stmts):
+                if stmt.mnemonic[0] == 'b' and target(p) == p+1 and p+1 not in barriers and \
+                   p not in protected and p not in removed:
+                    removed.add(p)
+
+            # Unreachable code, once other changes are applied
+            if not removed:
+                roots = {0} | barriers | returns
+                for stmt in asm:
+                    for o in stmt.operands:
+                        if o.kind == 'label' and stmt.mnemonic[0] != 'b' and o.value in at:
+                            roots.add(at[o.value])
+                removed = set(range(len(stmts))) - self._reachable(stmts, at, roots)
+
+            if not removed and not changed:
+                return asm
+
+            for p in removed:
+                # Keep labels of removed instructions
+                asm[code[p]] = stmts[p]._replace(inst='', mnemonic='', operands=())
+            asm = [stmt for stmt in asm if stmt.mnemonic != '' or stmt.label != '']
+
+            if not removed:
+                return asm
+
+    def _reachable(self, stmts, at, roots):
+        """Returns set of positions reachable from roots."""
+        reachable = set()
+        todo = list(roots)
+        while todo:
+            p = todo.pop()
+            if p in reachable or p >= len(stmts):
+                continue
+            reachable.add(p)
+            stmt = stmts[p]
+            if stmt.mnemonic[0] == 'b' and stmt.operands[0].value in at:
+                todo.append(at[stmt.operands[0].value])
+            if stmt.mnemonic != 'b' and not (stmt.mnemonic == 'set' and stmt.operands[0].value == 15):
+                todo.append(p+1)
+        return reachable
+
+    def _peephole(self, asm):
+        """Returns list of Statements with redundant instructions removed."""
+        self.labels = Assembler()._pass1(asm)
+        self.code = set()
+        self.values = {}
+        self.addresses = {}
+        self.ids = itertools.count()
+
+        removed = set()
+        for block in self._blocks(asm):
+            changed = True
+            while changed:
+                changed = False
+                for opt in (self._forward, self._backward):
+                    dead = opt(block)
+                    if dead:
+                        changed = True
+                        removed |= dead
+                        block = [(i, stmt) for i, stmt in block if i not in dead]
+
+        return [stmt for i, stmt in enumerate(asm) if i not in removed]
+
+    def _blocks(self, asm):
+        """Returns list of basic blocks, each a list of (index, Statement)
+        tuples. Also collects the names of code labels."""
+        blocks = []
+        block = []
+        section = 'code'
+        for i, stmt in enumerate(asm):
+            mnemonic = stmt.mnemonic
+            if stmt.label != '':
+                if section == 'code':
+                    self.code.add(stmt.label)
+                blocks.append(block)
+                block = []
+            if mnemonic == '' or mnemonic[0] == '.':
+                if mnemonic == '.section':
+                    section = stmt.operands[0].text
+                blocks.append(block)
+                block = []
+                continue
+            if section != 'code':
+                continue
+            if (mnemonic, tuple(o.kind for o in stmt.operands)) not in shapes:
+                # Leave malformed instructions to the assembler
+                blocks.append(block)
+                block = []
+                continue
+
+            block.append((i, stmt))
+            if mnemonic[0] == 'b' or (mnemonic == 'set' and stmt.operands[0].value == 15):
+                # Control transfer ends block
+                blocks.append(block)
+                block = []
+        blocks.append(block)
+
+        # Protect instructions following a read of pc
+        ret = []
+        for block in blocks:
+            for n, (i, stmt) in enumerate(block):
+                if stmt.mnemonic[0] != 'b' and stmt.operands[0].value == 15:
+                    block = block[:n]
+                    break
+            if block:
+                ret.append(block)
+        return ret
+
+    def _new(self):
+        """Returns a new value number."""
+        return next(self.ids)
+
+    def _const(self, o):
+        """Returns value number of a constant operand."""
+        if o.kind == 'label' and o.value in self.code:
+            # Code addresses change during optimization
+            key = ('label', o.value)
+        elif o.kind == 'label' and o.value in self.labels:
+            key = self.labels[o.value] % 256
+        elif o.kind in ('num', 'char'):
+            key = o.value % 256
+        else:
+            key = (o.kind, o.value)
+
+        if key not in self.values:
+            self.values[key] = self._new()
+            if isinstance(key, int):
+                self.addresses[self.values[key]] = key
+        return self.values[key]
+
+    def _memory(self, addr):
+        """Checks whether value number addr is a known address outside
+        the memory-mapped I/O registers."""
+        return self.addresses.get(addr, 0) > LCR
+
+    def _forward(self, block):
+        """Returns indices of instructions that do not change any value."""
+        dead = set()
+        acc = None
+        regs = {}
+        mem = {}
+
+        for i, stmt in block:
+            mnemonic = stmt.mnemonic
+            o = stmt.operands[0]
+
+            if mnemonic == 'ldi':
+                value = self._const(o)
+                if acc == value:
+                    dead.add(i)
+                acc = value
+            elif mnemonic == 'get':
+                value = regs.setdefault(o.value, self._new())
+                if acc == value:
+                    dead.add(i)
+                acc = value
+            elif mnemonic == 'set':
+                if acc is None:
+                    acc = self._new()
+                if regs.get(o.value) == acc:
+                    dead.add(i)
+                regs[o.value] = acc
+            elif mnemonic == 'lda':
+                addr = regs.setdefault(o.value, self._new())
+                if not self._memory(addr):
+                    acc = self._new()
+                elif acc is not None and mem.get(addr) == acc:
+                    dead.add(i)
+                else:
+                    acc = mem.setdefault(addr, self._new())
+            elif mnemonic == 'sta':
+                addr = regs.setdefault(o.value, self._new())
+                if acc is None:
+                    acc = self._new()
+                # Store may alias any other address
+                mem = {addr: acc} if self._memory(addr) else {}
+            elif mnemonic == 'inc' or mnemonic == 'dec':
+                regs[o.value] = self._new()
+            elif mnemonic in ALU:
+                acc = self._new()
+
+        return dead
+
+    def _backward(self, block):
+        """Returns indices of instructions whose results are never read."""
+        dead = set()
+        acc = True
+        flags = True
+
+        for i, stmt in reversed(block):
+            mnemonic = stmt.mnemonic
+            removable = stmt.label == ''
+
+            if mnemonic == 'ldi' or mnemonic == 'get' or mnemonic == 'lda':
+                if removable and not acc and mnemonic != 'lda':
+                    dead.add(i)
+                    continue
+                acc = False
+            elif mnemonic == 'set' or mnemonic == 'sta':
+                acc = True
+            elif mnemonic in ALU:
+                if removable and not acc and not flags:
+                    dead.add(i)
+                    continue
+                acc = True
+                flags = False
+            elif mnemonic == 'inc' or mnemonic == 'dec':
+                flags = False
+            elif mnemonic != 'b':
+                # Conditional branch
+                flags = True
+
+        return dead
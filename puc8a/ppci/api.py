@@ -3,11 +3,10 @@ The api module contains a set of handy functions to invoke compilation,
 linking and assembling.
 """
 
+import importlib
 import io
 import logging
 import os
-import stat
-import xml
 from .lang.c import preprocess, c_to_ir, COptions
 from .irutils import verify_module
 from .utils.reporting import DummyReportGenerator, HtmlReportGenerator
@@ -21,23 +20,41 @@ from .opt.mem2reg import Mem2RegPromotor
 from .opt.cjmp import CJumpPass
 from .opt.tailcall import TailCallOptimization
 from .codegen import CodeGenerator
-from .binutils.linker import link
-from .binutils.archive import archive
 from .binutils.outstream import BinaryOutputStream, TextOutputStream
 from .binutils.outstream import MasterOutputStream, FunctionOutputStream
 from .binutils.objectfile import ObjectFile, get_object
 from .binutils.debuginfo import DebugInfo
-from .binutils.disasm import Disassembler
-from .format.hexfile import HexFile
-from .format.elf import write_elf
-from .format.exefile import ExeWriter
-from .format import uboot_image
-from .format.ldb import write_ldb
 #from .build.tasks import TaskError, TaskRunner
 #from .build.recipe import RecipeLoader
 from .common import CompilerError, DiagnosticsManager, get_file
 from .arch import get_arch, get_current_arch
 
+# Names that are only needed for linking, disassembling and writing
+# object files are imported on first use, such that the compiler
+# does not pay for them at startup.
+_lazy = {
+    "link": ".binutils.linker",
+    "archive": ".binutils.archive",
+    "Disassembler": ".binutils.disasm",
+    "HexFile": ".format.hexfile",
+    "write_elf": ".format.elf",
+    "ExeWriter": ".format.exefile",
+    "uboot_image": ".format.uboot_image",
+    "write_ldb": ".format.ldb",
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        module = importlib.import_module(_lazy[name], __package__)
+        value = module if name == "uboot_image" else getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+
 # When using 'from ppci.api import *' include the following:
 __all__ = [
     "asm",
@@ -83,6 +100,8 @@ def construct(buildfile, targets=()):
 
     Raise task error if something goes wrong.
     """
+    import xml.parsers.expat
+
     # Ensure file:
     buildfile = get_file(buildfile)
     recipe_loader = RecipeLoader()
@@ -159,6 +178,8 @@ def disasm(data, march):
         >>> source_file = io.BytesIO([0x77])
         >>> disasm(source_file, 'arm')
     """
+    from .binutils.disasm import Disassembler
+
     march = get_arch(march)
     disassembler = Disassembler(march)
     f = get_file(data)
@@ -355,6 +376,12 @@ def cc(
 
 def objcopy(obj: ObjectFile, image_name: str, fmt: str, output_filename):
     """ Copy some parts of an object file to an output """
+    from .format.hexfile import HexFile
+    from .format.elf import write_elf
+    from .format.exefile import ExeWriter
+    from .format import uboot_image
+    from .format.ldb import write_ldb
+
     fmts = ["bin", "hex", "elf", "exe", "ldb", "uimage"]
     if fmt not in fmts:
         formats = ", ".join(fmts[:-1]) + " and " + fmts[-1]
@@ -408,5 +435,7 @@ def objcopy(obj: ObjectFile, image_name: str, fmt: str, output_filename):
 
 def chmod_x(filename):
     """ Perform sort of chmod +x on filename. """
+    import stat
+
     status = os.stat(filename)
     os.chmod(filename, status.st_mode | stat.S_IEXEC)
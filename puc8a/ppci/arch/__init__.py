@@ -24,7 +24,6 @@
 """
 
 import sys
-import platform
 
 from .arch import Architecture, Frame
 from .isa import Isa
@@ -32,6 +31,8 @@ from .isa import Isa
 
 def get_current_arch():
     """ Try to get the architecture for the current platform """
+    import platform
+
     if sys.platform.startswith("win"):
         machine = platform.machine()
         if machine == "AMD64":
@@ -41,6 +42,10 @@ def get_current_arch():
             return get_arch("x86_64")
 
 
+# Architectures created by name, shared by all users in this process
+_archs = {}
+
+
 def get_arch(arch):
     """Try to return an architecture instance.
 
@@ -62,12 +67,14 @@ def get_arch(arch):
         # Horrific import cycle created. TODO: restructure this
         from .target_list import create_arch
 
-        if ":" in arch:
-            # We have target with options attached
-            parts = arch.split(":")
-            return create_arch(parts[0], options=tuple(parts[1:]))
-        else:
-            return create_arch(arch)
+        if arch not in _archs:
+            if ":" in arch:
+                # We have target with options attached
+                parts = arch.split(":")
+                _archs[arch] = create_arch(parts[0], options=tuple(parts[1:]))
+            else:
+                _archs[arch] = create_arch(arch)
+        return _archs[arch]
     raise ValueError("Invalid architecture {}".format(arch))
 
 
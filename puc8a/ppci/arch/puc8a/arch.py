@@ -34,8 +34,15 @@ class PUC8aArch(Architecture):
 
         self.isa = instructions.isa + data_isa
 
-        self.assembler = BaseAssembler()
-        self.assembler.gen_asm_parser(self.isa)
+        self._assembler = None
+
+    @property
+    def assembler(self):
+        """ Assembler for inline assembly, generated on first use """
+        if self._assembler is None:
+            self._assembler = BaseAssembler()
+            self._assembler.gen_asm_parser(self.isa)
+        return self._assembler
 
     def get_runtime(self):
         """ Retrieve the runtime for this target """
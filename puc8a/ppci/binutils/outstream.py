@@ -13,6 +13,12 @@ from ..arch.generic_instructions import SectionInstruction
 from ..arch.generic_instructions import Global, SetSymbolType
 from ..arch.generic_instructions import ArtificialInstruction
 from ..arch.generic_instructions import RelocationHolder
+from ..arch.generic_instructions import PseudoInstruction, VirtualInstruction
+from ..arch.data_instructions import DZero
+from ..arch.encoding import Operand as SyntaxOperand
+from ..arch.registers import Register
+from ..common import CompilerError
+from ...assembler import Statement, Operand
 from .objectfile import RelocationEntry
 from . import debuginfo
 
@@ -190,6 +196,115 @@ class BinaryOutputStream(OutputStream):
         return symbol
 
 
+class ImageOutputStream(OutputStream):
+    """Output stream that builds puc8a assembler statements.
+
+    Instructions are translated into Statements directly from their
+    syntax and operand values, without rendering them as text. The mov
+    pseudo-instruction is expanded into get and set, .byte and .zero
+    become .db directives, and pseudo-instructions that have no puc8a
+    counterpart are dropped. Each Statement gets its own line in file,
+    following the statements the stream started with, so that the source
+    map refers to the assembly listing. Call flush when done; the
+    statements can then be passed to the puc8a Assembler.
+    """
+
+    def __init__(self, statements=(), file="<stdin>"):
+        self.statements = list(statements)
+        self.file = file
+        self.label = ""
+
+    def do_emit(self, item):
+        """ Translate the given item into statements """
+        if isinstance(item, Label):
+            self.flush()
+            self.label = item.name
+        elif isinstance(item, SectionInstruction):
+            self._append(".section", [Operand("name", item.name, item.name)])
+        elif isinstance(item, DZero):
+            for _ in range(item.v):
+                self._append(".db", [Operand("num", 0, "0")])
+        elif isinstance(
+            item, (PseudoInstruction, VirtualInstruction, RelocationHolder)
+        ):
+            pass
+        else:
+            mnemonic, operands = self._translate(item)
+            if mnemonic == "mov":
+                self._append("get", operands[1:])
+                self._append("set", operands[:1])
+            else:
+                self._append(".db" if mnemonic == ".byte" else mnemonic, operands)
+
+    def flush(self):
+        """ Emit a pending label that is not followed by an instruction """
+        if self.label:
+            self.statements.append(
+                Statement(self._source(), self.label, "", "", (), None)
+            )
+            self.label = ""
+
+    def _source(self):
+        return (self.file, len(self.statements) + 1)
+
+    def _append(self, mnemonic, operands):
+        inst = mnemonic
+        if operands:
+            inst += " " + ", ".join(o.text for o in operands)
+        self.statements.append(
+            Statement(
+                self._source(), self.label, inst, mnemonic, tuple(operands), None
+            )
+        )
+        self.label = ""
+
+    @staticmethod
+    def _translate(item):
+        """ Split instruction syntax into mnemonic and operands """
+        if getattr(item, "syntax", None) is None:
+            raise CompilerError(
+                "Cannot translate {} to puc8a assembly".format(item)
+            )
+
+        mnemonic = ""
+        parts = None
+        groups = []
+        for element in item.syntax.syntax:
+            if isinstance(element, SyntaxOperand):
+                element = element.__get__(item)
+            if parts is None:
+                if element == " ":
+                    parts = []
+                    groups.append(parts)
+                else:
+                    mnemonic += element
+            elif element == ",":
+                parts = []
+                groups.append(parts)
+            elif element != " ":
+                parts.append(element)
+
+        operands = []
+        for parts in groups:
+            if len(parts) == 1 and isinstance(parts[0], Register):
+                reg = parts[0].get_real()
+                operands.append(Operand("reg", reg.num, reg.name))
+            elif len(parts) == 3 and parts[0] == "[" and parts[2] == "]":
+                reg = parts[1].get_real()
+                operands.append(Operand("ind", reg.num, "[" + reg.name + "]"))
+            elif len(parts) == 2 and parts[0] == "@":
+                operands.append(Operand("label", parts[1], "@" + parts[1]))
+            elif len(parts) == 1 and isinstance(parts[0], int):
+                operands.append(Operand("num", parts[0], str(parts[0])))
+            else:
+                raise CompilerError(
+                    "Cannot translate operand {} of {} to puc8a assembly".format(
+                        "".join(str(p) for p in parts), item
+                    )
+                )
+        return mnemonic, operands
+
+
 class DummyOutputStream(OutputStream):
     """ Stream that does nothing """
 
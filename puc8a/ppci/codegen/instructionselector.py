@@ -258,7 +258,17 @@ class InstructionSelector1:
         self.reporter = reporter
         self.dag_splitter = DagSplitter(arch)
 
-        # Generate burm table of rules:
+        # The burm table only depends on the architecture and the weights,
+        # so it is generated once per architecture instance:
+        systems = arch.__dict__.setdefault("burg_systems", {})
+        weights = tuple(weights)
+        if weights not in systems:
+            systems[weights] = self._create_system(weights)
+        self.sys = systems[weights]
+        self.tree_selector = TreeSelector(self.sys)
+
+    def _create_system(self, weights):
+        """Generate burm table of rules."""
         self.sys = BurgSystem()
 
         for terminal in terminals:
@@ -272,7 +282,7 @@ class InstructionSelector1:
         self._create_undefined_rules()
 
         # Add all isa patterns:
-        for pattern in arch.isa.patterns:
+        for pattern in self.arch.isa.patterns:
             cost = (
                 pattern.size * weights[0]
                 + pattern.cycles * weights[1]
@@ -287,7 +297,7 @@ class InstructionSelector1:
             )
 
         self.sys.check()
-        self.tree_selector = TreeSelector(self.sys)
+        return self.sys
 
     def _create_undefined_rules(self):
         """Create rules for undefined values based on register classes."""
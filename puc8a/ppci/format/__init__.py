@@ -1,7 +1,24 @@
 """ Package for different file formats """
 
-from .elf import ElfFile
-from .hexfile import HexFile
+import importlib
+
+# Formats are imported on first use, such that loading one of them
+# does not load all others.
+_lazy = {
+    "ElfFile": ".elf",
+    "HexFile": ".hexfile",
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        module = importlib.import_module(_lazy[name], __package__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
 
 
 __all__ = ("HexFile", "ElfFile")
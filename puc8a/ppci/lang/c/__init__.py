@@ -1,17 +1,39 @@
 """ C front end. """
 
-from .context import CContext
-from .builder import CBuilder, create_ast, parse_text, parse_type
+import importlib
 from .lexer import CLexer
-from .parser import CParser
-from .semantics import CSemantics
-from .synthesize import CSynthesizer
 from .preprocessor import CPreProcessor
 from .utils import CAstPrinter, print_ast
-from .printer import CPrinter, render_ast
 from .options import COptions
 from .token import CTokenPrinter
-from .api import preprocess, c_to_ir
+
+# The parser and code generator are imported on first use, such that
+# preprocessing does not pay for them.
+_lazy = {
+    "CContext": ".context",
+    "CBuilder": ".builder",
+    "create_ast": ".builder",
+    "parse_text": ".builder",
+    "parse_type": ".builder",
+    "CParser": ".parser",
+    "CSemantics": ".semantics",
+    "CSynthesizer": ".synthesize",
+    "CPrinter": ".printer",
+    "render_ast": ".printer",
+    "preprocess": ".api",
+    "c_to_ir": ".api",
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        module = importlib.import_module(_lazy[name], __package__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
 
 
 __all__ = [
@@ -20,7 +20,8 @@ def c_to_ir(source: io.TextIOBase, march, coptions=None, reporter=None):
     """C to ir translation.
 
     Args:
-        source (file-like object): The C source to compile.
+        source (file-like object or list): The C source to compile, or
+            the tokens produced by preprocessing it.
         march (str): The targetted architecture.
         coptions: C specific compilation options.
 
@@ -38,7 +39,7 @@ def c_to_ir(source: io.TextIOBase, march, coptions=None, reporter=None):
 
     march = get_arch(march)
     cbuilder = CBuilder(march.info, coptions)
-    assert isinstance(source, io.TextIOBase)
+    assert isinstance(source, (io.TextIOBase, list))
     if hasattr(source, "name"):
         filename = getattr(source, "name")
     else:
@@ -64,8 +64,12 @@ def create_ast(src, arch_info, filename="<snippet>", coptions=None):
 
 
 def _parse(src, filename, context):
-    preprocessor = CPreProcessor(context.coptions)
-    tokens = preprocessor.process_file(src, filename)
+    if isinstance(src, list):
+        # Already preprocessed
+        tokens = src
+    else:
+        preprocessor = CPreProcessor(context.coptions)
+        tokens = preprocessor.process_file(src, filename)
     semantics = CSemantics(context)
     parser = CParser(context.coptions, semantics)
     tokens = prepare_for_parsing(tokens, parser.keywords)
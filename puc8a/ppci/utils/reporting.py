@@ -6,16 +6,13 @@
 """
 
 import abc
-import cgitb
 from contextlib import contextmanager
-from datetime import datetime
 import logging
 import io
 from .. import ir
 from .. import __version__
 from ..common import CompilerError
 from ..irutils import Writer
-from .graph2svg import Graph, LayeredLayout
 from ..codegen.selectiongraph import SGValue
 from ..binutils.outstream import TextOutputStream
 from ..binutils.debuginfo import DebugLocation
@@ -195,6 +192,8 @@ class TextReportGenerator(TextWritingReporter):
                 self.print("- {}".format(root))
 
     def dump_exception(self, einfo):
+        import cgitb
+
         self.print(cgitb.text(einfo))
 
     def dump_trees(self, trees):
@@ -331,6 +330,8 @@ class MyHandler(logging.Handler):
 
 
 def selection_graph_to_graph(sgraph):
+    from .graph2svg import Graph
+
     graph = Graph()
     node_map = {}  # Mapping from SGNode to Node
     for node in sgraph.nodes:
@@ -375,6 +376,8 @@ class HtmlReportGenerator(TextWritingReporter):
                 self.print("<pre>")
 
     def header(self):
+        from datetime import datetime
+
         self.print(HTML_HEADER)
         self.message(
             "Generated on {} by ppci version {}".format(
@@ -431,6 +434,8 @@ class HtmlReportGenerator(TextWritingReporter):
             self.print("</pre>")
 
     def render_graph(self, graph):
+        from .graph2svg import LayeredLayout
+
         LayeredLayout().generate(graph)
         graph.to_svg(self.dump_file)
 
@@ -457,6 +462,8 @@ class HtmlReportGenerator(TextWritingReporter):
                 self.print("- {}".format(root))
 
     def dump_exception(self, einfo):
+        import cgitb
+
         self.print(cgitb.html(einfo))
 
     def dump_trees(self, trees):
@@ -0,0 +1,116 @@
+"""Execution profiler for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import sys
+
+from .simulator import Translator
+
+class Profiler:
+    """Collects execution statistics of a simulated program.
+
+    Pass enter as hook to Simulator.run, and call finish with the final
+    state afterwards. Statistics are kept per code address; the source map
+    of the image relates them back to source lines."""
+    def __init__(self, sim, image):
+        self.image = image
+        table, state = sim.load(image)
+
+        self.lengths = [Translator.length(handler) for handler, r, imm in table]
+        self.targets = {}
+        for pc, (handler, r, imm) in enumerate(table):
+            target = sim.target(handler, imm)
+            if target is not None:
+                self.targets[pc] = target
+
+        self.counts = [0 for pc in table]
+        self.taken = [0 for pc in table]
+        self.last = None
+
+    def enter(self, state, pc):
+        """Counts execution of the instruction at pc."""
+        last = self.last
+        if last in self.targets and pc == self.targets[last]:
+            self.taken[last] += 1
+        self.counts[pc] += 1
+        self.last = pc
+
+    def finish(self, state):
+        """Accounts for the outcome of the last executed instruction."""
+        last = self.last
+        if last in self.targets and state.regs[15] == self.targets[last]:
+            self.taken[last] += 1
+        self.last = None
+
+    def cycles(self, pc):
+        """Returns number of cycles spent at pc."""
+        return self.counts[pc] * self.lengths[pc]
+
+    def source(self, pc):
+        """Returns (file, line, text) of the source of the instruction at pc."""
+        source = self.image.sources['code'][pc]
+        comment = self.image.comments['code'][pc]
+        if source is None:
+            return '', 0, comment
+
+        # Listing text follows the file:line prefix of the comment
+        return source[0], source[1], comment.split(':', 2)[-1][1:].rstrip()
+
+    def loops(self):
+        """Returns list of (start, end, iterations, cycles) of executed
+        backward branches, sorted by cycles."""
+        loops = []
+        for pc, target in self.targets.items():
+            if target <= pc and self.taken[pc] > 0:
+                cycles = sum(self.cycles(a) for a in range(target, pc+1))
+                loops.append((target, pc, self.taken[pc], cycles))
+        return sorted(loops, key=lambda l: -l[3])
+
+    def lines(self):
+        """Returns list of (cycles, count, file, line, text) per source line,
+        sorted by cycles."""
+        lines = {}
+        for pc in range(len(self.counts)):
+            if self.counts[pc] > 0:
+                file, line, text = self.source(pc)
+                if (file, line) not in lines:
+                    lines[(file, line)] = [0, 0, text]
+                lines[(file, line)][0] += self.cycles(pc)
+                lines[(file, line)][1] += self.counts[pc]
+        return sorted([(c, n, file, line, text) for (file, line), (c, n, text) in lines.items()],
+                      key=lambda l: (-l[0], l[2], l[3]))
+
+    def report(self, f=None, top=10):
+        """Prints hot spots, hot loops, branch statistics and an annotated
+        source listing sorted by cycles to f (default: standard output)."""
+        f = f or sys.stdout
+        steps = sum(self.counts)
+        total = max(sum(self.cycles(pc) for pc in range(len(self.counts))), 1)
+
+        def where(pc):
+            file, line, text = self.source(pc)
+            return f'{file}:{line}: {text}' if file != '' else text
+
+        print(f'Profile of {steps} steps ({total} cycles)', file=f)
+
+        print('\nHot spots:', file=f)
+        print(f'{"addr":>5} {"count":>9} {"cycles":>9} {"%":>6}  source', file=f)
+        hot = sorted([pc for pc in range(len(self.counts)) if self.counts[pc] > 0], key=lambda pc: -self.cycles(pc))
+        for pc in hot[:top]:
+            print(f'{pc:5} {self.counts[pc]:9} {self.cycles(pc):9} {100*self.cycles(pc)/total:6.1f}  {where(pc)}', file=f)
+
+        print('\nHot loops:', file=f)
+        print(f'{"start":>5} {"end":>5} {"iters":>9} {"cycles":>9} {"%":>6}  source', file=f)
+        for start, end, iterations, cycles in self.loops()[:top]:
+            print(f'{start:5} {end:5} {iterations:9} {cycles:9} {100*cycles/total:6.1f}  {where(start)}', file=f)
+
+        print('\nBranches:', file=f)
+        print(f'{"addr":>5} {"taken":>9} {"not taken":>9}  source', file=f)
+        for pc in sorted(self.targets):
+            if self.counts[pc] > 0:
+                print(f'{pc:5} {self.taken[pc]:9} {self.counts[pc]-self.taken[pc]:9}  {where(pc)}', file=f)
+
+        print('\nSource lines by cycles:', file=f)
+        print(f'{"count":>9} {"cycles":>9} {"%":>6}  source', file=f)
+        for cycles, count, file, line, text in self.lines():
+            print(f'{count:9} {cycles:9} {100*cycles/total:6.1f}  {file}:{line}: {text}', file=f)
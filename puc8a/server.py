@@ -0,0 +1,270 @@
+"""Compile server for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+
+Requests and responses are JSON objects, one per line:
+
+   {"id": 1, "command": "compile", "args": ["hello.c", "-t", "8"], "cwd": "/tmp"}
+   {"id": 1, "status": 0, "stdout": "", "stderr": "Halted at PC 8 ...",
+    "output": [[2, "Halted at PC 8 ..."]]}
+
+command is compile, assemble or simulate, and args are the arguments of
+cc-puc8a, as-puc8a or sim-puc8a, respectively. Files are read and written
+relative to cwd. output holds the standard output (1) and error (2) text in
+the order in which it was written. Responses are written in order of
+completion.
+"""
+
+import os, sys, io, json, signal, socket, socketserver, threading, traceback, contextlib
+import concurrent.futures, concurrent.futures.process
+
+COMMANDS = {'compile': 'cc-puc8a', 'assemble': 'as-puc8a', 'simulate': 'sim-puc8a'}
+
+# Environment variable with the socket of a server to forward to
+ENVIRONMENT = 'PUC8A_SERVER'
+
+WARMUP = 'int x; void main(void) { x = x + 1; }'
+
+# Set in worker processes
+WORKER = False
+
+# Working directory of requests that do not give one
+DIRECTORY = os.getcwd()
+
+def warmup():
+    """Loads the tools and builds the code generator and assembler tables,
+    such that later requests only pay for their own work."""
+    from . import cc, asm, sim
+    from .compiler import compile
+    from .assembler import Assembler
+
+    for level in (0, 2):
+        Assembler().process(compile(io.StringIO(WARMUP), level))
+
+def initialize():
+    """Prepares worker process."""
+    global WORKER
+    WORKER = True
+    # Simulations must not read the request stream
+    sys.stdin = open(os.devnull, 'r')
+    warmup()
+
+class Capture(io.TextIOBase):
+    """Text stream that records what is written to it in output, which
+    is shared with the other streams of a request."""
+    def __init__(self, fd, output):
+        self.fd = fd
+        self.name = ['<stdout>', '<stderr>'][fd-1]
+        self.output = output
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if self.output and self.output[-1][0] == self.fd:
+            self.output[-1][1] += s
+        elif s != '':
+            self.output.append([self.fd, s])
+        return len(s)
+
+    def getvalue(self):
+        return ''.join(text for fd, text in self.output if fd == self.fd)
+
+def run(request):
+    """Runs request as if the corresponding tool was called from the
+    command line, and returns the response."""
+    from . import cc, asm, sim
+    main = {'compile': cc.main, 'assemble': asm.main, 'simulate': sim.main}[request['command']]
+
+    output = []
+    stdout, stderr = Capture(1, output), Capture(2, output)
+    argv = sys.argv
+    try:
+        os.chdir(request.get('cwd', DIRECTORY))
+        sys.argv = [COMMANDS[request['command']]] + list(request['args'])
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                main()
+                status = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        sys.argv = argv
+        os.chdir(DIRECTORY)
+
+    return {'id': request.get('id'), 'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'output': output}
+
+def failure(id, status, message):
+    """Returns response to a request that could not be run."""
+    return {'id': id, 'status': status, 'stdout': '', 'stderr': message, 'output': [[2, message]]}
+
+class Server:
+    """Runs requests on a pool of warm worker processes. If a worker dies,
+    the requests it was running fail and the pool is replaced when the
+    next request is submitted."""
+    def __init__(self, workers=None):
+        global DIRECTORY
+        DIRECTORY = os.getcwd()
+        # Workers must not forward requests back to the server
+        os.environ.pop(ENVIRONMENT, None)
+        # Warm up before forking, such that workers inherit the tables
+        warmup()
+        self.workers = workers or os.cpu_count() or 1
+        self.lock = threading.RLock()
+        self.pool = None
+        self.start()
+
+    def start(self):
+        """Starts a new pool of workers."""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=initialize)
+        # Start workers now rather than on the first request
+        list(self.pool.map(abs, range(self.workers)))
+
+    def restart(self, pool):
+        """Replaces pool by a new one, unless that already happened."""
+        with self.lock:
+            if self.pool is pool:
+                print('Worker died, restarting pool', file=sys.stderr)
+                pool.shutdown(wait=False)
+                self.start()
+
+    def submit(self, request):
+        """Returns future of request submitted to the pool."""
+        with self.lock:
+            pool = self.pool
+            try:
+                return pool.submit(run, request)
+            except concurrent.futures.process.BrokenProcessPool:
+                self.restart(pool)
+                return self.pool.submit(run, request)
+
+    def stream(self, fin, fout):
+        """Handles requests read from binary file fin until end of file,
+        writing the responses to binary file fout."""
+        lock = threading.Condition()
+        pending = 0
+
+        def reply(response):
+            with lock:
+                try:
+                    fout.write(json.dumps(response).encode() + b'\n')
+                    fout.flush()
+                except OSError:
+                    pass  # Client went away
+
+        def done(future, id):
+            nonlocal pending
+            # Runs in the thread that manages the pool, so it must not
+            # replace the pool itself
+            try:
+                response = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                response = failure(id, 1, 'Server error: worker process died\n')
+            except Exception as e:
+                response = failure(id, 1, f'Server error: {e!r}\n')
+            reply(response)
+            with lock:
+                pending -= 1
+                lock.notify()
+
+        for line in fin:
+            if line.strip() == b'':
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                if request.get('command') not in COMMANDS:
+                    raise ValueError(f'unknown command {request.get("command")}')
+                if not isinstance(request.get('args'), list):
+                    raise ValueError('args must be a list')
+            except (ValueError, AttributeError) as e:
+                id = request.get('id') if isinstance(request, dict) else None
+                reply(failure(id, 2, f'Invalid request: {e}\n'))
+                continue
+
+            with lock:
+                pending += 1
+            future = self.submit(request)
+            future.add_done_callback(lambda future, id=request.get('id'): done(future, id))
+
+        # Responses are written by the pool, so wait until all are sent
+        with lock:
+            lock.wait_for(lambda: pending == 0)
+
+    def serve(self, path):
+        """Handles requests on Unix socket path, or standard input and
+        output if path is -, until interrupted or end of file."""
+        if path == '-':
+            self.stream(sys.stdin.buffer, sys.stdout.buffer)
+            return
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.stream(self.rfile, self.wfile)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        # Stop cleanly when terminated
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as s:
+            print(f'Serving on {path} with {self.workers} workers', file=sys.stderr)
+            try:
+                s.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(path)
+
+    def close(self):
+        self.pool.shutdown()
+
+def serve(path, workers=None):
+    """Runs server on path with the given number of worker processes."""
+    if WORKER:
+        raise RuntimeError('Cannot start server from within a request')
+    server = Server(workers)
+    try:
+        server.serve(path)
+    finally:
+        server.close()
+
+def request(path, command, args, cwd=None):
+    """Runs command with args on the server at Unix socket path, and
+    returns the response."""
+    request = {'id': 0, 'command': command, 'args': list(args), 'cwd': cwd or os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+def forward(command):
+    """Runs command with the current command line arguments on the server
+    named by the PUC8A_SERVER environment variable, prints its output and
+    exits with its status. Returns if there is no server to connect to,
+    such that the command can run locally instead."""
+    path = os.environ.get(ENVIRONMENT)
+    if not path:
+        return
+
+    try:
+        response = request(path, command, sys.argv[1:])
+    except (OSError, ValueError):
+        return
+
+    for fd, text in response['output']:
+        stream = sys.stdout if fd == 1 else sys.stderr
+        stream.write(text)
+        stream.flush()
+    sys.exit(response['status'])
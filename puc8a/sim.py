@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Image simulator for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import os, sys, codecs, argparse
+
+from .loader import load, loadsymbols, loadsourcemap, deduce, PARSERS
+from .simulator import Simulator
+from .devices import Bus
+from .profiler import Profiler
+from .tracer import Tracer
+
+def simulate(image, args, test=None):
+    """Simulates image as requested by the simulation options of the
+    command-line arguments args. The simulation is interactive, unless
+    args.simulate is not set and test is given or profiling or tracing is
+    requested. In that case it runs until halted, and a RuntimeError is
+    raised if it did not halt at PC test."""
+    if args.input is not None:
+        bus = Bus.standard(codecs.decode(args.input, 'unicode_escape'))
+    else:
+        bus = None
+    sim = Simulator(bus=bus)
+    if args.simulate or not (test is not None or args.profile or args.trace):
+        sim.process(image)
+        return
+
+    if args.profile:
+        profiler = Profiler(sim, image)
+        pc = sim.run(image, args.max_steps, hook=profiler.enter)
+        profiler.finish(sim.state)
+        profiler.report()
+    elif args.trace:
+        with open(args.trace, 'wb') as t:
+            tracer = Tracer(sim, image, t)
+            pc = sim.run(image, args.max_steps, hook=tracer.enter)
+            tracer.finish(sim.state)
+    else:
+        pc = sim.run(image, args.max_steps)
+    print(f'{"Halted" if sim.halted else "Stopped"} at PC {pc} after {sim.steps} steps ({sim.cycles} cycles)', file=sys.stderr)
+    if test is not None and pc != test:
+        raise RuntimeError('PC after ' + str(sim.steps) + ' steps is ' + str(pc) + ', expected ' + str(test))
+
+def main():
+    parser = argparse.ArgumentParser(description='PUC8a image simulator (c) 2020-2025 Wouter Caarls, PUC-Rio')
+    parser.add_argument('file', type=str,
+                        help='Image file written by as-puc8a or cc-puc8a')
+    parser.add_argument('-f', '--format', type=str, choices=['vhdl'] + list(PARSERS),
+                        help='Image format (default: deduced from extension)')
+    parser.add_argument('--data', metavar='FILE', type=str,
+                        help='Data memory image (default: FILE with _ram appended to its base name, if it exists)')
+    parser.add_argument('--symbols', metavar='FILE', type=str,
+                        help='Symbol table (default: FILE with extension .sym, if it exists)')
+    parser.add_argument('--map', metavar='FILE', type=str,
+                        help='Source map (default: FILE with extension .map, if it exists)')
+    parser.add_argument('-s', '--simulate', action='store_true',
+                        help='Simulate program interactively')
+    parser.add_argument('-t', '--test', metavar='N', type=str,
+                        help='Simulate until halted and check whether PC == N (number or label)')
+    parser.add_argument('--max-steps', metavar='N', type=int, default=1000,
+                        help='Maximum number of steps to simulate when testing, profiling or tracing')
+    observe = parser.add_mutually_exclusive_group()
+    observe.add_argument('-p', '--profile', action='store_true',
+                        help='Simulate until halted and print execution profile')
+    observe.add_argument('--trace', metavar='FILE', type=str,
+                        help='Simulate until halted and record binary execution trace')
+    parser.add_argument('-i', '--input', type=str,
+                        help='Keyboard input for simulation, instead of prompting (escape sequences such as \\r are allowed)')
+
+    args = parser.parse_args()
+    if args.format is None and deduce(args.file) not in ['vhdl'] + list(PARSERS):
+        parser.error(f'Cannot deduce image format of {args.file}, use --format')
+    interactive = args.simulate or not (args.test is not None or args.profile or args.trace)
+
+    # Non-interactive work may be done by a running server instead
+    if os.environ.get('PUC8A_SERVER') and not interactive:
+        from .server import forward
+        forward('simulate')
+
+    image = load(args.file, args.format, args.data)
+
+    base = os.path.splitext(args.file)[0]
+    symbols = args.symbols if args.symbols is not None else base + '.sym'
+    if args.symbols is not None or os.path.exists(symbols):
+        with open(symbols, 'r') as f:
+            loadsymbols(image, f)
+    sourcemap = args.map if args.map is not None else base + '.map'
+    if args.map is not None or os.path.exists(sourcemap):
+        with open(sourcemap, 'r') as f:
+            loadsourcemap(image, f)
+
+    if args.test is not None:
+        name = args.test.lstrip('@')
+        if name in image.symbols:
+            test = image.symbols[name]
+        else:
+            try:
+                test = int(args.test, 0)
+            except ValueError:
+                parser.error(f'Unknown label {args.test}')
+    else:
+        test = None
+
+    simulate(image, args, test)
+
+if __name__ == '__main__':
+    main()
@@ -2,47 +2,68 @@
    (c) 2020-2025 Wouter Caarls, PUC-Rio
 """
 
-import copy
+import re
+from array import array
+from functools import partial
+
 from .disassembler import Disassembler
+from .devices import Bus, BTN, ENC, KDR, UDR, USR, LED, SSD, LDR, LCR
 
 class State:
-    """Machine state for simulator."""
+    """Machine state for simulator.
+
+    The state is updated in place by Simulator.step; use copy() when the
+    previous state must be retained. Registers are kept in a list because
+    the PC of an oversized program may run past 255."""
+    __slots__ = ('acc', 'regs', 'mem', 'zero', 'carry', 'negative', 'overflow')
+
     def __init__(self):
         self.acc = 0
         self.regs = [0 for i in range(16)]
-        self.mem = [0 for i in range(256)]
+        self.mem = bytearray(256)
         self.regs[14] = 255
         self.zero = False
         self.carry = False
         self.negative = False
         self.overflow = False
 
+    def copy(self):
+        """Returns an independent copy of this state."""
+        other = State.__new__(State)
+        other.acc = self.acc
+        other.regs = self.regs[:]
+        other.mem = self.mem[:]
+        other.zero = self.zero
+        other.carry = self.carry
+        other.negative = self.negative
+        other.overflow = self.overflow
+        return other
+
     def diff(self, state):
         """Calculates difference between this state and another."""
-        d = ''
+        d = []
 
         if self.acc != state.acc:
-            d += f', acc <- {state.acc}'
+            d.append(f'acc <- {state.acc}')
         for i in range(14):
             if self.regs[i] != state.regs[i]:
-                d += f', r{i} <- {state.regs[i]}'
-        for i in range(256):
-            if self.mem[i] != state.mem[i]:
-                d += f', [{i}] <- {state.mem[i]}'
+                d.append(f'r{i} <- {state.regs[i]}')
+        if self.mem != state.mem:
+            for i in range(256):
+                if self.mem[i] != state.mem[i]:
+                    d.append(f'[{i}] <- {state.mem[i]}')
         if self.regs[14] != state.regs[14]:
-            d += f', sp <- {state.regs[14]}'
+            d.append(f'sp <- {state.regs[14]}')
         if self.zero != state.zero:
-            d += f', zf <- {state.zero}'
+            d.append(f'zf <- {state.zero}')
         if self.carry != state.carry:
-            d += f', cf <- {state.carry}'
+            d.append(f'cf <- {state.carry}')
         if self.negative != state.negative:
-            d += f', nf <- {state.negative}'
+            d.append(f'nf <- {state.negative}')
         if self.overflow != state.overflow:
-            d += f', vf <- {state.overflow}'
+            d.append(f'vf <- {state.overflow}')
 
-        if d != '':
-            d = d[2:]
-        return d
+        return ', '.join(d)
 
     def __str__(self):
         s = f'acc = {self.acc}, '
@@ -52,103 +73,603 @@ class State:
 
         return s
 
+def location(name):
+    """Returns location of a register ('r3', 'sp'), memory address
+    ('[0x20]') or I/O register ('led'), in Journal format."""
+    name = name.strip().lower()
+    io = {'btn': BTN, 'enc': ENC, 'kdr': KDR, 'udr': UDR, 'usr': USR,
+          'led': LED, 'ssd': SSD, 'ldr': LDR, 'lcr': LCR}
+    if name in io:
+        return 16 + io[name]
+    elif name == 'fp':
+        return 13
+    elif name == 'sp':
+        return 14
+    elif name == 'pc':
+        return 15
+    elif len(name) > 2 and name[0] == '[' and name[-1] == ']':
+        return 16 + int(name[1:-1], 0)
+    elif len(name) > 1 and name[0] == 'r':
+        return int(name[1:])
+    raise ValueError(f'Invalid location {name}')
+
+def describe(loc):
+    """Returns name of a location in Journal format."""
+    if loc >= 16:
+        return f'[{loc-16}]'
+    return ['fp', 'sp', 'pc'][loc-13] if loc >= 13 else f'r{loc}'
+
+def condition(expr):
+    """Compiles a breakpoint condition such as 'r3 == 7 and [0x20] > 10'
+    into a predicate taking (state, regs, mem)."""
+    io = {'btn': BTN, 'enc': ENC, 'kdr': KDR, 'udr': UDR, 'usr': USR,
+          'led': LED, 'ssd': SSD, 'ldr': LDR, 'lcr': LCR}
+    names = {'fp': 'regs[13]', 'sp': 'regs[14]', 'pc': 'regs[15]', 'acc': 'state.acc',
+             'zf': 'state.zero', 'cf': 'state.carry', 'nf': 'state.negative', 'vf': 'state.overflow'}
+
+    def replace(m):
+        name = m.group(0).lower()
+        if name == '[':
+            return 'mem['
+        elif name in names:
+            return names[name]
+        elif name in io:
+            return f'mem[{io[name]}]'
+        elif name[0] == 'r' and name[1:].isdigit():
+            return f'regs[{int(name[1:])}]'
+        elif name in ['and', 'or', 'not']:
+            return name
+        raise ValueError(f'Unknown name {m.group(0)} in condition')
+
+    src = re.sub(r'\[|\b[A-Za-z_]\w*\b', replace, expr)
+    return eval(compile(f'lambda state, regs, mem: {src}', '<condition>', 'eval'), {'__builtins__': {}})
+
+class Journal:
+    """Undo journal for simulator state.
+
+    Each record holds the PC, accumulator and flags before a change, plus
+    the location it wrote (a register index, 16 + a memory address, or -1)
+    and the previous value there. Since an instruction writes at most one
+    register or memory byte, memory use is linear in the number of steps.
+    Records are packed into an array of machine integers.
+
+    Undone records move to a redo list, so that named snapshots can be
+    restored in both directions. Recording a new change discards the redo
+    list and any snapshots that lie ahead. Device side effects, such as
+    consumed keyboard input or LCD output, are not undone."""
+    WIDTH = 5
+
+    # The and, or, xor and shft instructions set the overflow flag to 0
+    _overflow = (False, True, 0)
+
+    def __init__(self):
+        self.undo = array('i')
+        self.redo = array('i')
+        self.snapshots = {}
+
+    def __len__(self):
+        return len(self.undo) // self.WIDTH
+
+    def record(self, state, loc):
+        """Records state before writing to loc."""
+        if self.redo:
+            del self.redo[:]
+            self.snapshots = {name: pos for name, pos in self.snapshots.items() if pos <= len(self)}
+        self._push(self.undo, state, loc)
+
+    def back(self, state, n=1):
+        """Undoes at most n changes. Returns number of changes undone."""
+        n = min(n, len(self))
+        for i in range(n):
+            self._pop(self.undo, self.redo, state)
+        return n
+
+    def forward(self, state, n=1):
+        """Redoes at most n undone changes. Returns number of changes redone."""
+        n = min(n, len(self.redo) // self.WIDTH)
+        for i in range(n):
+            self._pop(self.redo, self.undo, state)
+        return n
+
+    def mark(self):
+        """Returns current journal position, for use with diff()."""
+        return len(self.undo), len(self.redo)
+
+    def diff(self, state, mark):
+        """Calculates difference between the state at mark and the current
+        state, in the format of State.diff. Only the locations written
+        since mark are compared."""
+        undo, redo = mark
+        if len(self.undo) > undo:
+            records = self.undo[undo:]
+        elif len(self.redo) > redo:
+            records = self.redo[redo:]
+        else:
+            return ''
+
+        # Oldest value of every written location
+        old = {}
+        for i in range(len(records) - self.WIDTH, -1, -self.WIDTH):
+            old[records[i+3]] = records[i+4]
+        flags = records[2]
+
+        d = []
+        if records[1] != state.acc:
+            d.append(f'acc <- {state.acc}')
+        for loc in sorted(old):
+            if loc < 0 or loc == 14 or loc == 15:
+                continue
+            val = state.regs[loc] if loc < 16 else state.mem[loc-16]
+            if old[loc] != val:
+                d.append(f'r{loc} <- {val}' if loc < 16 else f'[{loc-16}] <- {val}')
+        if 14 in old and old[14] != state.regs[14]:
+            d.append(f'sp <- {state.regs[14]}')
+        if bool(flags & 1) != state.zero:
+            d.append(f'zf <- {state.zero}')
+        if bool(flags & 2) != state.carry:
+            d.append(f'cf <- {state.carry}')
+        if bool(flags & 4) != state.negative:
+            d.append(f'nf <- {state.negative}')
+        if self._overflow[flags >> 3] != state.overflow:
+            d.append(f'vf <- {state.overflow}')
+
+        return ', '.join(d)
+
+    def save(self, name):
+        """Saves a named snapshot of the current state."""
+        self.snapshots[name] = len(self)
+
+    def load(self, state, name):
+        """Restores a named snapshot."""
+        pos = self.snapshots[name]
+        if pos <= len(self):
+            self.back(state, len(self) - pos)
+        else:
+            self.forward(state, pos - len(self))
+
+    def _push(self, records, state, loc):
+        """Appends state before writing to loc to records."""
+        ov = state.overflow
+        flags = state.zero | state.carry << 1 | state.negative << 2 | (1 if ov is True else 0 if ov is False else 2) << 3
+        if loc < 0:
+            old = 0
+        elif loc < 16:
+            old = state.regs[loc]
+        else:
+            old = state.mem[loc-16]
+        records.extend((state.regs[15], state.acc, flags, loc, old))
+
+    def _pop(self, records, other, state):
+        """Restores state from the last record, saving the current state
+        to other."""
+        pc, acc, flags, loc, old = records[-self.WIDTH:]
+        del records[-self.WIDTH:]
+        self._push(other, state, loc)
+
+        if loc >= 16:
+            state.mem[loc-16] = old
+        elif loc >= 0:
+            state.regs[loc] = old
+        state.regs[15] = pc
+        state.acc = acc
+        state.zero = bool(flags & 1)
+        state.carry = bool(flags & 2)
+        state.negative = bool(flags & 4)
+        state.overflow = self._overflow[flags >> 3]
+
+class Translator:
+    """Translates basic blocks of decoded machine code into Python functions.
+
+    A block starts at a hot address and extends until a branch, a write to
+    the PC, or the next static branch target. Flags are only computed for
+    the last ALU instruction of a block, since nothing inside the block can
+    observe the others. A block that branches back to its own start loops
+    internally for as long as the step budget allows. Code memory cannot be
+    written, so translated blocks remain valid for as long as the image is
+    loaded.
+
+    Translated functions take (state, regs, mem, budget) and return the
+    number of instructions executed, which is at most budget."""
+    HOT = 8
+    MAX_LENGTH = 64
+
+    _branches = {'_b': None,
+                 '_bz': 'state.zero', '_bnz': 'not state.zero',
+                 '_bcs': 'state.carry', '_bcc': 'not state.carry',
+                 '_blt': 'state.overflow != state.negative',
+                 '_bge': 'state.overflow == state.negative'}
+    _alu = {'_add', '_sub', '_inc', '_dec', '_and', '_or', '_xor', '_shft'}
+
+    def __init__(self, sim, table):
+        self.table = table
+        self.env = {'devices': sim.bus.devices}
+        self.blocks = {}
+        self.counts = {}
+
+        # Find static branch targets by sweeping the instruction stream
+        self.targets = set()
+        pc = 0
+        while pc < len(table):
+            handler, r, imm = table[pc]
+            if handler.__name__ in self._branches:
+                self.targets.add(imm)
+            pc += self.length(handler)
+
+    @staticmethod
+    def length(handler):
+        """Returns instruction length in bytes."""
+        if handler.__name__ == '_ldi' or handler.__name__ in Translator._branches:
+            return 2
+        return 1
+
+    def enter(self, pc):
+        """Counts an interpreted visit to pc, translating the block starting
+        there once it becomes hot."""
+        count = self.counts.get(pc, 0) + 1
+        self.counts[pc] = count
+        if count == self.HOT:
+            block = self.translate(pc)
+            if block is not None:
+                self.blocks[pc] = block
+
+    def translate(self, entry):
+        """Compiles the block starting at entry. Returns (function, length,
+        cycles), where length is the number of instructions in the block
+        and cycles the number of bytes they occupy."""
+        insts = []
+        pc = entry
+        while pc < len(self.table) and len(insts) < self.MAX_LENGTH:
+            handler, r, imm = self.table[pc]
+            name = handler.__name__
+            if name == '_illegal':
+                break
+            if name in self._branches and imm == entry and pc == entry:
+                # Leave halting self-branches to the interpreter
+                break
+            insts.append((pc, name, r, imm))
+            pc += self.length(handler)
+            if name in self._branches or (r == 15 and name in ('_set', '_inc', '_dec')):
+                break
+            if pc in self.targets:
+                break
+
+        if len(insts) == 0:
+            return None
+
+        last_alu = max([i for i, inst in enumerate(insts) if inst[1] in self._alu], default=-1)
+
+        body = []
+        for i, (pc, name, r, imm) in enumerate(insts):
+            body += self._emit(pc, name, r, imm, i == last_alu)
+
+        # Fall through if block did not end with a jump
+        pc, name, r, imm = insts[-1]
+        if not (name in self._branches or (r == 15 and name in ('_set', '_inc', '_dec'))):
+            body.append(f'pc = {pc + self.length(self.table[pc][0])}')
+
+        n = len(insts)
+        src = [f'def block_{entry}(state, regs, mem, budget):',
+               '    acc = state.acc']
+        if name in self._branches and imm == entry:
+            src += ['    n = 0',
+                    '    while True:',
+                    f'        n += {n}']
+            src += ['        ' + line for line in body]
+            src += [f'        if pc != {entry} or n + {n} > budget:',
+                    '            break']
+        else:
+            src += ['    ' + line for line in body]
+            src.append(f'    n = {n}')
+        src += ['    state.acc = acc',
+                '    regs[15] = pc',
+                '    return n']
+
+        env = dict(self.env)
+        exec(compile('\n'.join(src), f'<block {entry}>', 'exec'), env)
+        return env[f'block_{entry}'], n, sum(self.length(self.table[pc][0]) for pc, _, _, _ in insts)
+
+    def _emit(self, pc, name, r, imm, flags):
+        """Returns source lines for a single instruction."""
+        # Reading the PC yields the address of the next instruction
+        reg = str(pc+1) if r == 15 else f'regs[{r}]'
+
+        if name == '_lda':
+            return [f'v = {reg}',
+                    'if v in devices:',
+                    '    acc = devices[v].read(mem, v)',
+                    'else:',
+                    '    acc = mem[v]']
+        elif name == '_sta':
+            return [f'v = {reg}',
+                    'if v in devices:',
+                    '    devices[v].write(mem, v, acc)',
+                    'else:',
+                    '    mem[v] = acc']
+        elif name == '_ldi':
+            return [f'acc = {imm}']
+        elif name in self._branches:
+            cond = self._branches[name]
+            if cond is None:
+                return [f'pc = {imm}']
+            return [f'pc = {imm} if {cond} else {pc+2}']
+        elif name == '_get':
+            return [f'acc = {reg}']
+        elif name == '_set':
+            if r == 15:
+                return ['pc = acc']
+            return [f'regs[{r}] = acc']
+
+        # ALU instructions
+        lines = [f'v = {reg}']
+        if name == '_add':
+            lines.append('res = acc + v')
+            overflow = 'bool((~(acc ^ v) & (acc ^ res)) & 128)'
+        elif name == '_sub':
+            lines.append('res = acc + (256-v)')
+            overflow = 'bool(( (acc ^ v) & (acc ^ res)) & 128)'
+        elif name == '_inc':
+            lines.append('res = v + 1')
+            overflow = 'bool((~(v ^ 1) & (v ^ res)) & 128)'
+        elif name == '_dec':
+            lines.append('res = v + 255')
+            overflow = 'bool(( (v ^ 1) & (v ^ res)) & 128)'
+        elif name == '_shft':
+            lines.append('res = acc >> (256-v) if v > 127 else acc << v')
+            overflow = '0'
+        else:
+            op = {'_and': '&', '_or': '|', '_xor': '^'}[name]
+            lines.append(f'res = acc {op} v')
+            overflow = '0'
+
+        if flags:
+            lines += [f'state.overflow = {overflow}',
+                      'state.zero = ((res&255) == 0)',
+                      'state.carry = bool(res & 256)',
+                      'state.negative = bool(res & 128)']
+
+        if (name == '_inc' or name == '_dec') and r == 15:
+            lines.append('pc = res&255')
+        elif name == '_inc' or name == '_dec':
+            lines.append(f'regs[{r}] = res&255')
+        else:
+            lines.append('acc = res&255')
+        return lines
+
 class Simulator:
     """Simulates machine code."""
-    def __init__(self, map = None):
+    # Maximum length of a loop that run() recognizes as a halt
+    HALT_WINDOW = 1024
+
+    def __init__(self, map = None, jit = True, bus = None):
         self.disassembler = Disassembler(map)
+        self.jit = jit
+        self.bus = bus if bus is not None else Bus.standard()
+        self._devices = self.bus.devices
+        self._translators = {}
 
-    def execute(self, bin, bin2, state):
-        """Returns machine state after executing instruction."""
-        # Disassemble instruction
-        m, _ = self.disassembler.process(bin, bin2)
-
-        opcode = bin[0:4]
-        r = int(bin[4:8], 2)
-        imm = int(bin2, 2)
-        next = copy.deepcopy(state)
-        next.regs[15] += 1
-
-        val = next.regs[r]
-
-        # Simulate instructions
-        if m == 'lda':
-            if val == 2:
-                inp = input('Enter keyboard character: ')
-                if len(inp) > 0:
-                    next.acc = ord(inp[0])
-                else:
-                    next.acc = 0
-            else:
-                next.acc = state.mem[val]
-        elif m == 'sta':
-            if val == 7:
-                print(chr(state.acc), end='')
-            elif val == 8 and state.acc == 1:
-                print()
-            else:
-                next.mem[val] = state.acc
-        elif m == 'ldi':
-            next.acc = imm
-            next.regs[15] += 1
-        elif m[0] == 'b':
-            # Direct jumps
-            if ( m == 'b' or
-                (m == 'bz' and state.zero) or (m == 'bnz' and not state.zero) or
-                (m == 'bcs' and state.carry) or (m == 'bcc' and not state.carry) or
-                (m == 'blt' and (state.overflow != state.negative)) or
-                (m == 'bge' and (state.overflow == state.negative))):
-                    next.regs[15] = imm
-            else:
-                next.regs[15] += 1
-        elif m == 'get':
-            next.acc = val
-        elif m == 'set':
-            next.regs[r] = state.acc
+        # Final state and statistics of last run()
+        self.state = None
+        self.steps = 0
+        self.cycles = 0
+        self.halted = False
+
+        # Handlers indexed by 4-bit opcode; ldi and branches also check the minor
+        self._handlers = [self._lda, self._sta, None, None, None, None,
+                          self._get, self._set, self._add, self._sub,
+                          self._inc, self._dec, self._and, self._or,
+                          self._xor, self._shft]
+        self._branches = [self._b, self._bz, self._bnz, self._bcs,
+                          self._bcc, self._blt, self._bge]
+
+    def decode(self, inst, inst2):
+        """Returns handler and operands for a single instruction."""
+        opcode = inst >> 4
+        r = inst & 15
+
+        if opcode == 4 and r == 0:
+            return self._ldi, r, inst2
+        elif opcode == 5 and r < len(self._branches):
+            return self._branches[r], r, inst2
+        elif self._handlers[opcode] is not None:
+            return self._handlers[opcode], r, inst2
         else:
-            # ALU instructions (modify flags)
-            next.overflow = 0
-            if m == 'add':
-                res = state.acc + val
-                next.overflow = bool((~(state.acc ^ val) & (state.acc ^ res)) & 128)
-            elif m == 'inc':
-                res = val + 1
-                next.overflow = bool((~(val ^ 1) & (val ^ res)) & 128)
-            elif m == 'sub':
-                res = state.acc + (256-val)
-                next.overflow = bool(( (state.acc ^ val) & (state.acc ^ res)) & 128)
-            elif m == 'dec':
-                res = val + 255
-                next.overflow = bool(( (val ^ 1) & (val ^ res)) & 128)
-            elif m == 'shft':
-                if val > 127:
-                    res = state.acc >> (256-val)
-                else:
-                    res = state.acc << val
-            elif m == 'and':
-                res = state.acc & val
-            elif m == 'or':
-                res = state.acc | val
-            elif m == 'xor':
-                res = state.acc ^ val
-            else:
-                raise ValueError(f'Unknown opcode {opcode} (\'{m}\')')
+            return self._illegal, inst, inst2
 
-            next.zero = ((res&255) == 0)
-            next.carry = bool(res & 256)
-            next.negative = bool(res & 128)
+    def load(self, image):
+        """Decodes code memory into a table of (handler, r, imm) entries
+        indexed by address, and returns it together with the initial state."""
+        code = image.code
+        table = [self.decode(c, code[(i+1)%len(code)]) for i, c in enumerate(code)]
 
-            if m == 'inc' or m == 'dec':
-                next.regs[r] = res&255
-            else:
-                next.acc = res&255
+        state = State()
+        if len(image.data) > len(state.mem):
+            raise ValueError(f'Data section has {len(image.data)} bytes, but data memory has only {len(state.mem)}')
+        state.mem[:len(image.data)] = image.data
 
+        return table, state
+
+    def execute(self, inst, inst2, state):
+        """Returns machine state after executing instruction."""
+        next = state.copy()
+        self.step(inst, inst2, next)
         return next
 
+    def step(self, inst, inst2, state):
+        """Executes instruction, modifying machine state in place."""
+        handler, r, imm = self.decode(inst, inst2)
+        handler(state, r, imm)
+
+    def target(self, handler, imm):
+        """Returns branch target of a decoded instruction, or None if it
+        is not a branch."""
+        if handler.__name__ in Translator._branches:
+            return imm
+        return None
+
+    def written(self, state, handler, r):
+        """Returns the location an instruction is about to write, in
+        Journal format: a register index, 16 + a memory address, or -1
+        if it only changes the PC, accumulator or flags."""
+        if handler == self._sta:
+            return 16 + (state.regs[15]+1 if r == 15 else state.regs[r])
+        elif r != 15 and (handler == self._set or handler == self._inc or handler == self._dec):
+            return r
+        return -1
+
+    def reads(self, state, handler, r):
+        """Returns the locations an instruction is about to read, in
+        Journal format. The accumulator and flags are not included."""
+        if handler == self._ldi or handler == self._set or handler == self._illegal or \
+           handler.__name__ in Translator._branches:
+            return []
+        elif handler == self._lda:
+            return [r, 16 + (state.regs[15]+1 if r == 15 else state.regs[r])]
+        return [r]
+
+    def _illegal(self, state, inst, imm):
+        raise ValueError(f'Illegal instruction {inst:08b}')
+
+    def _lda(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        val = regs[r]
+        if val in self._devices:
+            state.acc = self._devices[val].read(state.mem, val)
+        else:
+            state.acc = state.mem[val]
+
+    def _sta(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        val = regs[r]
+        if val in self._devices:
+            self._devices[val].write(state.mem, val, state.acc)
+        else:
+            state.mem[val] = state.acc
+
+    def _ldi(self, state, r, imm):
+        state.acc = imm
+        state.regs[15] += 2
+
+    def _branch(self, state, taken, imm):
+        if taken:
+            state.regs[15] = imm
+        else:
+            state.regs[15] += 2
+
+    def _b(self, state, r, imm):
+        state.regs[15] = imm
+
+    def _bz(self, state, r, imm):
+        self._branch(state, state.zero, imm)
+
+    def _bnz(self, state, r, imm):
+        self._branch(state, not state.zero, imm)
+
+    def _bcs(self, state, r, imm):
+        self._branch(state, state.carry, imm)
+
+    def _bcc(self, state, r, imm):
+        self._branch(state, not state.carry, imm)
+
+    def _blt(self, state, r, imm):
+        self._branch(state, state.overflow != state.negative, imm)
+
+    def _bge(self, state, r, imm):
+        self._branch(state, state.overflow == state.negative, imm)
+
+    def _get(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        state.acc = regs[r]
+
+    def _set(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        regs[r] = state.acc
+
+    def _flags(self, state, res):
+        """Sets zero, carry and negative flags according to ALU result."""
+        state.zero = ((res&255) == 0)
+        state.carry = bool(res & 256)
+        state.negative = bool(res & 128)
+        return res&255
+
+    def _add(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        acc, val = state.acc, regs[r]
+        res = acc + val
+        state.overflow = bool((~(acc ^ val) & (acc ^ res)) & 128)
+        state.acc = self._flags(state, res)
+
+    def _sub(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        acc, val = state.acc, regs[r]
+        res = acc + (256-val)
+        state.overflow = bool(( (acc ^ val) & (acc ^ res)) & 128)
+        state.acc = self._flags(state, res)
+
+    def _inc(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        val = regs[r]
+        res = val + 1
+        state.overflow = bool((~(val ^ 1) & (val ^ res)) & 128)
+        regs[r] = self._flags(state, res)
+
+    def _dec(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        val = regs[r]
+        res = val + 255
+        state.overflow = bool(( (val ^ 1) & (val ^ res)) & 128)
+        regs[r] = self._flags(state, res)
+
+    def _and(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        state.overflow = 0
+        state.acc = self._flags(state, state.acc & regs[r])
+
+    def _or(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        state.overflow = 0
+        state.acc = self._flags(state, state.acc | regs[r])
+
+    def _xor(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        state.overflow = 0
+        state.acc = self._flags(state, state.acc ^ regs[r])
+
+    def _shft(self, state, r, imm):
+        regs = state.regs
+        regs[15] += 1
+        val = regs[r]
+        state.overflow = 0
+        if val > 127:
+            res = state.acc >> (256-val)
+        else:
+            res = state.acc << val
+        state.acc = self._flags(state, res)
+
     def help(self):
         print("""Available commands:
    h       This help.
    n       Advance to next instruction.
+   back n  Undo last n steps or changes (default 1).
+   fwd n   Redo n steps or changes undone by back (default 1).
+   save s  Save snapshot named s.
+   load s  Restore snapshot named s.
    b a     Set or clear breakpoint at address a.
+   b a if x Set breakpoint at address a that stops when x holds,
+           e.g. b 30 if r3 == 7 and [0x20] > 10.
+   w x     Set or clear write watchpoint on register or address x,
+           e.g. w r3 or w [0x20].
+   wr x    Set or clear read watchpoint on register or address x.
    c       Execute continuously until halted.
    p       Print current state.
    q       Exit simulator.
@@ -158,53 +679,127 @@ class Simulator:
    [a] = y Set memory address a to value y.
 """)
 
-    def process(self, mem):
+    def _hit(self, state, cond):
+        """Returns whether a breakpoint with optional (text, predicate)
+        condition triggers."""
+        if cond is None:
+            return True
+        try:
+            return cond[1](state, state.regs, state.mem)
+        except Exception as e:
+            print(f'{cond[0]}: {e}')
+            return True
+
+    def process(self, image):
         """Simulate machine code."""
-        state = State()
-        for i, c in enumerate(mem['data']):
-            state.mem[i] = int(c[0], 2)
+        table, state = self.load(image)
+        code = list(image.code)
 
+        journal = Journal()
+        regs = state.regs
         breakpoints = []
+        conditions = {}
+        wwatch, rwatch = set(), set()
+        watches = {'w': wwatch, 'wr': rwatch}
         quiet = False
         men = None
 
-        while True:
-            # Print current instruction
-            bin = mem['code'][state.regs[15]][0]
-            bin2 = mem['code'][(state.regs[15]+1)%len(mem['code'])][0]
+        # Breakpoint bitmap, covering every address the PC can take
+        armed = bytearray(max(256, len(table)+2))
 
+        while True:
             if quiet:
-                next = copy.deepcopy(self.execute(bin, bin2, state))
-                if next.regs[15] == state.regs[15] or next.regs[15] in breakpoints:
+                pc = regs[15]
+                handler, r, imm = table[pc]
+                loc = self.written(state, handler, r)
+                journal.record(state, loc)
+                if rwatch:
+                    read = rwatch.intersection(self.reads(state, handler, r))
+                handler(state, r, imm)
+                if regs[15] == pc or armed[regs[15]] and self._hit(state, conditions.get(regs[15])):
+                    quiet = False
+                if loc in wwatch:
+                    print(f'watchpoint: {describe(loc)} written')
+                    quiet = False
+                if rwatch and read:
+                    print(f'watchpoint: {", ".join(describe(l) for l in sorted(read))} read')
                     quiet = False
-                state = next
                 continue
 
-            mne, dis = self.disassembler.process(bin, bin2)
+            # Print current instruction
+            inst = code[state.regs[15]]
+            inst2 = code[(state.regs[15]+1)%len(code)]
+            bin, bin2 = f'{inst:08b}', f'{inst2:08b}'
+
+            mne, dis = self.disassembler.process(inst, inst2)
             if mne == 'ldi' or mne[0] == 'b':
                 print(f'{state.regs[15]:3}: {bin[0:4]} {bin[4:8]} {bin2} ({dis})')
             else:
                 print(f'{state.regs[15]:3}: {bin[0:4]} {bin[4:8]} ({dis})')
 
-            next = copy.deepcopy(state)
+            # Keep journal position to show difference
+            mark = journal.mark()
 
             # Present interface
             cmd = input('>> ').strip()
             if cmd == '' or cmd == 'n':
                 # Advance to next instruction
-                next = self.execute(bin, bin2, state)
+                handler, r, imm = table[state.regs[15]]
+                journal.record(state, self.written(state, handler, r))
+                handler(state, r, imm)
+            elif cmd.split()[0] in ['back', 'fwd']:
+                # Undo or redo changes
+                try:
+                    tokens = cmd.split()
+                    n = int(tokens[1], 0) if len(tokens) > 1 else 1
+                    if tokens[0] == 'back':
+                        n = journal.back(state, n)
+                    else:
+                        n = journal.forward(state, n)
+                    print(f'{tokens[0]} {n}')
+                except Exception as e:
+                    print(e)
+            elif cmd.split()[0] in ['save', 'load'] and len(cmd.split()) == 2:
+                # Save or restore named snapshot
+                tokens = cmd.split()
+                if tokens[0] == 'save':
+                    journal.save(tokens[1])
+                elif tokens[1] in journal.snapshots:
+                    journal.load(state, tokens[1])
+                else:
+                    print(f'unknown snapshot {tokens[1]}')
             elif cmd == 'c':
                 # Execute continuously
                 quiet = True
+            elif cmd.split()[0] in ['w', 'wr'] and len(cmd.split()) == 2:
+                # Set (or clear) watchpoint
+                try:
+                    tokens = cmd.split()
+                    loc = location(tokens[1])
+                    watches[tokens[0]] ^= {loc}
+                    print('write watchpoints: ', [describe(l) for l in sorted(wwatch)])
+                    print('read watchpoints: ', [describe(l) for l in sorted(rwatch)])
+                except Exception as e:
+                    print(e)
             elif cmd[0] == 'b':
-                # Set (or clear) breakpoint
+                # Set (or clear) breakpoint, optionally with condition
                 try:
-                    line = int(cmd[2:], 0)
-                    if line in breakpoints:
+                    tokens = cmd[2:].split(' if ', 1)
+                    line = int(tokens[0], 0)
+                    if len(tokens) == 2:
+                        conditions[line] = tokens[1].strip(), condition(tokens[1])
+                        if line not in breakpoints:
+                            breakpoints.append(line)
+                    elif line in breakpoints:
                         breakpoints.remove(line)
+                        conditions.pop(line, None)
                     else:
                         breakpoints.append(line)
+                    if 0 <= line < len(armed):
+                        armed[line] = line in breakpoints
                     print('breakpoints: ', breakpoints)
+                    for line in conditions:
+                        print(f'   {line} if {conditions[line][0]}')
                 except Exception as e:
                     print(e)
             elif cmd == 'p':
@@ -225,7 +820,9 @@ class Simulator:
                         print(e)
                 elif len(tokens) == 2:
                     try:
-                        next.regs[int(tokens[0][1:])] = int(tokens[1], 0)&255
+                        reg, val = range(16)[int(tokens[0][1:])], int(tokens[1], 0)&255
+                        journal.record(state, reg)
+                        state.regs[reg] = val
                     except Exception as e:
                         print(e)
                 else:
@@ -242,7 +839,9 @@ class Simulator:
                         print(e)
                 elif len(tokens) == 2:
                     try:
-                        next.mem[int(tokens[0][1:-1])] = int(tokens[1], 0)&255
+                        addr, val = range(256)[int(tokens[0][1:-1])], int(tokens[1], 0)&255
+                        journal.record(state, 16 + addr)
+                        state.mem[addr] = val
                     except Exception as e:
                         print(e)
                 else:
@@ -251,20 +850,92 @@ class Simulator:
                 self.help()
 
             # Print resulting difference
-            diff = state.diff(next)
+            diff = journal.diff(state, mark)
             if diff != '':
                 print('     ' + diff)
-            state = copy.deepcopy(next)
 
-    def run(self, mem, steps=1000):
-        """Simulate machine code for a set number of steps and return PC."""
-        state = State()
-        for i, c in enumerate(mem['data']):
-            state.mem[i] = int(c[0], 2)
+    def run(self, image, steps=1000, hook=None):
+        """Simulate machine code for at most a set number of steps and return PC.
+
+        Simulation stops early when the program halts, i.e. when it returns
+        to an earlier state without consuming input or producing output in
+        between. Since the program would then repeat forever, the returned
+        PC is the same as if all steps had been executed. The number of
+        steps and cycles actually simulated are stored in self.steps and
+        self.cycles.
+
+        If given, hook(state, pc) is called before every instruction. This
+        disables basic-block translation. The final state is stored in
+        self.state."""
+        table, state = self.load(image)
+        regs = state.regs
+        lengths = [Translator.length(handler) for handler, r, imm in table]
+        selfloops = {pc for pc, (handler, r, imm) in enumerate(table) if lengths[pc] == 2 and handler != self._ldi and imm == pc}
+
+        if hook is not None:
+            blocks = {}
+            enter = partial(hook, state)
+        elif self.jit:
+            # Translated blocks are cached per code image
+            key = bytes(image.code)
+            if key not in self._translators:
+                self._translators[key] = Translator(self, table)
+            translator = self._translators[key]
+            blocks = translator.blocks
+            enter = translator.enter
+        else:
+            blocks = {}
+            enter = None
+
+        mem = state.mem
+        bus = self.bus
+        window = self.HALT_WINDOW
+        s = 0
+        cycles = 0
+        halted = False
+
+        # Snapshot for detecting repeated states
+        snap = None
+        snap_s = 0
+        snap_events = bus.events
+
+        while s < steps:
+            pc = regs[15]
+            block = blocks.get(pc)
+            if block is not None and block[1] <= steps - s:
+                # Limit internal looping so repeated states can be observed
+                n = block[0](state, regs, mem, min(steps - s, window))
+                s += n
+                cycles += n // block[1] * block[2]
+            else:
+                if enter is not None:
+                    enter(pc)
+                handler, r, imm = table[pc]
+                handler(state, r, imm)
+                s += 1
+                cycles += lengths[pc]
+
+            if halted:
+                continue
+
+            if regs[15] == pc and pc in selfloops:
+                # Taken branch to itself does not change state
+                halted = True
+                break
+            elif snap is not None and regs[15] == snap[0] and bus.events == snap_events and \
+               snap == (regs[15], state.acc, state.zero, state.carry, state.negative, state.overflow, regs[:15], bytes(mem)):
+                # Program is stuck in a loop of s - snap_s steps. Only
+                # simulate what is needed to end up at the same point.
+                halted = True
+                steps = s + (steps - s) % (s - snap_s)
+            elif snap is None or s - snap_s >= window or bus.events != snap_events:
+                snap = (regs[15], state.acc, state.zero, state.carry, state.negative, state.overflow, regs[:15], bytes(mem))
+                snap_s = s
+                snap_events = bus.events
 
-        for s in range(steps):
-            bin = mem['code'][state.regs[15]][0]
-            bin2 = mem['code'][(state.regs[15]+1)%len(mem['code'])][0]
-            state = copy.deepcopy(self.execute(bin, bin2, state))
+        self.steps = s
+        self.cycles = cycles
+        self.halted = halted
+        self.state = state
 
-        return state.regs[15]
+        return regs[15]
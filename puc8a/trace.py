@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""Trace query tool for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import argparse, itertools
+
+from .tracer import Trace, location
+
+def main():
+    parser = argparse.ArgumentParser(description='PUC8a trace query tool (c) 2020-2025 Wouter Caarls, PUC-Rio')
+    parser.add_argument('file', type=str,
+                        help='Trace file recorded with --trace')
+    query = parser.add_mutually_exclusive_group()
+    query.add_argument('-w', '--writes', metavar='LOC', type=str,
+                        help='Show steps that write to LOC (r3, sp, [0x20], led, ...)')
+    query.add_argument('-c', '--changes', metavar='LOC', type=str,
+                        help='Show steps that change the value at LOC')
+    query.add_argument('-v', '--visits', metavar='PC', type=lambda x: int(x, 0),
+                        help='Show steps that execute the instruction at PC')
+    query.add_argument('-b', '--between', metavar='PC', type=lambda x: int(x, 0), nargs=2,
+                        help='Show number of steps from reaching the first PC to reaching the second')
+    parser.add_argument('-n', metavar='N', type=int,
+                        help='Show at most N results')
+
+    args = parser.parse_args()
+
+    trace = Trace(args.file)
+
+    if args.writes is not None:
+        results = trace.writes(location(args.writes))
+    elif args.changes is not None:
+        results = trace.changes(location(args.changes))
+    elif args.visits is not None:
+        results = trace.visits(args.visits)
+    elif args.between is not None:
+        for first, last in itertools.islice(trace.between(*args.between), args.n):
+            print(f'{first:8} - {last:8}: {last-first} steps')
+        return
+    else:
+        results = enumerate(trace)
+
+    for step, rec in itertools.islice(results, args.n):
+        print(trace.format(step, rec))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Binary execution trace for ENG1448 8-bit accumulator-based processor
+   (c) 2020-2025 Wouter Caarls, PUC-Rio
+"""
+
+import mmap, struct
+from collections import namedtuple
+
+from .simulator import location, describe
+
+# File header, followed by the initial data memory
+MAGIC = b'PUC8TRC\x01'
+
+# Per-step record: pc, instruction, accumulator and flags after the step,
+# location written (see Journal) and value written.
+RECORD = struct.Struct('<HBBBHB')
+NOWHERE = 0xFFFF
+
+Record = namedtuple('Record', ['pc', 'inst', 'acc', 'flags', 'loc', 'value'])
+
+class Tracer:
+    """Writes a binary execution trace.
+
+    Pass enter as hook to Simulator.run, and call finish with the final
+    state afterwards. Every step produces one fixed-width record, written
+    through a buffered file."""
+    def __init__(self, sim, image, f):
+        self.sim = sim
+        self.table, state = sim.load(image)
+        self.code = image.code
+        self.f = f
+        self.pending = None
+
+        f.write(MAGIC)
+        f.write(bytes(state.mem))
+
+    def enter(self, state, pc):
+        """Completes the record of the previous step and starts a new one."""
+        if self.pending is not None:
+            self._write(state)
+        handler, r, imm = self.table[pc]
+        self.pending = pc, self.sim.written(state, handler, r)
+
+    def finish(self, state):
+        """Completes the record of the last step."""
+        if self.pending is not None:
+            self._write(state)
+        self.pending = None
+
+    def _write(self, state):
+        pc, loc = self.pending
+        if loc < 0:
+            loc, value = NOWHERE, 0
+        elif loc < 16:
+            value = state.regs[loc]
+        else:
+            # Value stored, even if a device did not keep it
+            value = state.acc
+        flags = state.zero | state.carry << 1 | state.negative << 2 | bool(state.overflow) << 3
+        self.f.write(RECORD.pack(pc, self.code[pc], state.acc, flags, loc, value))
+
+class Trace:
+    """Memory-mapped binary execution trace.
+
+    Indexing yields Records by step number. The query methods scan the
+    trace and yield (step, Record) tuples."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{filename} is not a trace file')
+        self.start = len(MAGIC) + 256
+        self.mem = bytes(self.data[len(MAGIC):self.start])
+
+    def __len__(self):
+        return (len(self.data) - self.start) // RECORD.size
+
+    def __getitem__(self, step):
+        if step < 0:
+            step += len(self)
+        if step < 0 or step >= len(self):
+            raise IndexError('trace index out of range')
+        return Record._make(RECORD.unpack_from(self.data, self.start + step*RECORD.size))
+
+    def __iter__(self):
+        end = self.start + len(self)*RECORD.size
+        return map(Record._make, RECORD.iter_unpack(memoryview(self.data)[self.start:end]))
+
+    def writes(self, loc):
+        """Yields all steps that write to loc."""
+        for step, rec in enumerate(self):
+            if rec.loc == loc:
+                yield step, rec
+
+    def changes(self, loc):
+        """Yields all steps that change the value at loc."""
+        if loc >= 16:
+            value = self.mem[loc-16]
+        else:
+            value = 255 if loc == 14 else 0
+        for step, rec in self.writes(loc):
+            if rec.value != value:
+                value = rec.value
+                yield step, rec
+
+    def visits(self, pc):
+        """Yields all steps that execute the instruction at pc."""
+        for step, rec in enumerate(self):
+            if rec.pc == pc:
+                yield step, rec
+
+    def between(self, start, end):
+        """Yields (first, last) step pairs, running from an execution of
+        the instruction at start to the next execution of the one at end."""
+        first = None
+        for step, rec in enumerate(self):
+            if first is None:
+                if rec.pc == start:
+                    first = step
+            elif rec.pc == end:
+                yield first, step
+                first = None
+
+    def format(self, step, rec):
+        """Returns a line describing a record."""
+        flags = ''.join(f if rec.flags & (1 << i) else '-' for i, f in enumerate('zcnv'))
+        s = f'{step:8}: {rec.pc:3}: {rec.inst:08b} acc = {rec.acc:3}, {flags}'
+        if rec.loc != NOWHERE:
+            s += f', {describe(rec.loc)} <- {rec.value}'
+        return s
@@ -25,7 +25,10 @@ setup(name='puc8a',
       keywords='assembler compiler educational risc processor',
       packages=find_packages(),
       package_data={'': ['*.grammar']},
+      extras_require={'batch': ['numpy']},
       entry_points = {
         'console_scripts': ['as-puc8a=puc8a.asm:main',
-                            'cc-puc8a=puc8a.cc:main']
+                            'cc-puc8a=puc8a.cc:main',
+                            'trace-puc8a=puc8a.trace:main',
+                            'sim-puc8a=puc8a.sim:main']
       })